@@ -1,13 +1,42 @@
 #! /usr/bin/env python3
 import numpy as np
 import sys
+import os
+import tempfile
+import json
+import time
+import contextlib
 from scipy.spatial.transform import Rotation
 import nibabel as nb
-from nipype.interfaces.dcm2nii import Dcm2niix
-from nipype.interfaces.fsl import FLIRT, ConvertXFM, FSLCommand, ExtractROI
 import logging
 
-def qform2SiemensProtocol(qform,dims):
+# assuming "std" pe direction, define initial orientation transforms
+TRANSVERSAL = np.diag([1,1,1,1])
+CORONAL = np.array(
+    [[   1,   0,   0,   0 ],
+     [   0,   0,   1,   0 ],
+     [   0,  -1,   0,   0 ],
+     [   0,   0,   0,   1 ]])
+SAGITTAL = np.array(
+    [[   0,   0,   1,   0 ],
+     [   1,   0,   0,   0 ],
+     [   0,  -1,   0,   0 ],
+     [   0,   0,   0,   1 ]])
+# define orientation types:
+# orientation = rotOrder, peEstRotOrder, rotStr1, rotStr2, initialOrientation, negAngleIdx
+ORIENTATIONS = [['XYZ',   '','T>C','>S',TRANSVERSAL, 1],
+                ['YXZ','XYZ','T>S','>C',TRANSVERSAL, 0],
+                ['ZXY',   '','C>S','>T',CORONAL,     1],
+                ['XZY','ZXY','C>T','>S',CORONAL,     0],
+                ['ZYX',   '','S>C','>T',SAGITTAL,    1],
+                ['YZX','ZYX','S>T','>C',SAGITTAL,    0]]
+# one row per input qform and valid orientation type, position (dX, dY, dZ) in DICOM scanner
+# coordinates (LPH), angle1/angle2 the tilts named by rot1/rot2, peAngles the possible PE angles
+PROTOCOL_DTYPE = np.dtype([('index', 'i8'), ('orientation', 'i1'), ('position', 'f8', (3,)),
+                           ('rot1', 'U3'), ('angle1', 'f8'), ('rot2', 'U2'), ('angle2', 'f8'),
+                           ('peAngles', 'f8', (4,))])
+
+def qform2SiemensProtocolBatch(qforms,dims):
     # qform = DS2NS * dLPH * R * IO * NV2DV
     #
     # DS2NS: DICOM Scanner coordinates (LPH) to NIFTI Scanner Coordinates (RAS)
@@ -17,94 +46,424 @@ def qform2SiemensProtocol(qform,dims):
     #        (also depends on PE Orientation!)
     #        IO = [transversal/coronal/sagittal]  * dVoxel * centerSlab
     # NV2DV: NIFTI voxel indices to DICOM voxel indices
-    qform = np.matrix(qform)
+    #
+    # qforms is a (N,4,4) stack of qforms, dims their (N,3) (or common (3,)) dimensions,
+    # returns a structured array (PROTOCOL_DTYPE) with the parameters of every valid orientation
+    qforms = np.asarray(qforms, dtype=float).reshape(-1,4,4)
+    N = len(qforms)
+    nI, nJ, nK = np.broadcast_to(np.asarray(dims, dtype=float), (N,3)).T
     # calculate voxel dimensions
-    dI, dJ, dK = np.sqrt(np.diag(np.matmul(qform.T,qform)))[:3]
-    nI, nJ, nK = dims
-    NV2DV = np.concatenate((np.diag([1,-1,1,1])[:,:3],
-                            np.matrix([0, nJ-1, 0, 1]).T),axis=1)
-    DS2NS = np.matrix(np.diag([-1,-1,1,1]))    
-    dVoxel = np.matrix(np.diag([dI,dJ,dK,1]))
-    centerSlab =  np.concatenate((np.eye(4)[:,:3],
-                                  np.matrix([-nI/2, -nJ/2, -(nK/2-0.5), 1]).T),axis=1)
-    # assuming "std" pe direction, define initial orientation transforms
-    transversal = np.matrix(np.diag([1,1,1,1]))
-    coronal = np.matrix(
-        [[   1,   0,   0,   0 ],
-         [   0,   0,   1,   0 ],
-         [   0,  -1,   0,   0 ],
-         [   0,   0,   0,   1 ]])
-    sagittal = np.matrix(
-        [[   0,   0,   1,   0 ],
-         [   1,   0,   0,   0 ],
-         [   0,  -1,   0,   0 ],
-         [   0,   0,   0,   1 ]])
-    # define orientation types:
-    # orientation = rotOrder, peEstRotOrder, rotStr1, rotStr2, initialOrientation, PE, negAngleIdx
-    orientations = [['XYZ',   '','T>C','>S',transversal, 1],
-                    ['YXZ','XYZ','T>S','>C',transversal, 0],
-                    ['ZXY',   '','C>S','>T',coronal,     1],
-                    ['XZY','ZXY','C>T','>S',coronal,     0],
-                    ['ZYX',   '','S>C','>T',sagittal,    1],
-                    ['YZX','ZYX','S>T','>C',sagittal,    0]]
-    # for each possible orientation type estimate parameters:
-    for rotOrder, peEstRotOrder, rot1Str, rot2Str, initialOrientation, negAngleIdx in orientations:
-        IO = initialOrientation * dVoxel * centerSlab
-        dLPH_R = DS2NS.I * qform * NV2DV.I * IO.I
-        dX, dY, dZ =  dLPH_R.T.round(1).tolist()[3][:3]
-        R = dLPH_R[:3,:3]
-        rot = Rotation.from_matrix(R)
-        r1, r2, r3 = rot.as_euler(rotOrder,degrees=True).round(1)
+    dI, dJ, dK = np.sqrt(np.einsum('nij,nij->nj', qforms, qforms))[:,:3].T
+    NV2DV = np.tile(np.diag([1.,-1,1,1]), (N,1,1))
+    NV2DV[:,1,3] = nJ-1
+    DS2NS = np.diag([-1.,-1,1,1])
+    dVoxel = np.zeros((N,4,4))
+    dVoxel[:,[0,1,2,3],[0,1,2,3]] = np.stack([dI,dJ,dK,np.ones(N)], axis=1)
+    centerSlab = np.tile(np.eye(4), (N,1,1))
+    centerSlab[:,:3,3] = np.stack([-nI/2, -nJ/2, -(nK/2-0.5)], axis=1)
+    DS2NS_q_NV2DV = np.linalg.inv(DS2NS) @ qforms @ np.linalg.inv(NV2DV)
+    # for each possible orientation type estimate parameters, vectorized over all qforms:
+    rows = []
+    for orientation, (rotOrder, peEstRotOrder, rot1Str, rot2Str, initialOrientation,
+                      negAngleIdx) in enumerate(ORIENTATIONS):
+        IO = initialOrientation @ dVoxel @ centerSlab
+        dLPH_R = DS2NS_q_NV2DV @ np.linalg.inv(IO)
+        position = dLPH_R[:,:3,3].round(1)
+        R = dLPH_R[:,:3,:3]
+        # the handedness of the qform rules out the orientation types with a different one
+        # (no proper rotation, recent scipy versions refuse to convert these)
+        index = np.flatnonzero(np.linalg.det(R) > 0)
+        if len(index) == 0:
+            continue
+        rot = Rotation.from_matrix(R[index])
+        r1, r2, r3 = rot.as_euler(rotOrder,degrees=True).round(1).T
         # Here a bit of magic happens, I estimate the 1st two rotations assuming a different rotation sequence
         # then for estimating the PE angle, but only for every 2nd orientation type
         # It seems to work, but at the moment I cannot explain why, I believe it has to do with the
         # orientation transformations being a mix of intrinsic and extrinsic rotations
-        if any(peEstRotOrder):            
-            _, _, r3 = rot.as_euler(peEstRotOrder,degrees=True).round(1)
+        if any(peEstRotOrder):
+            r3 = rot.as_euler(peEstRotOrder,degrees=True).round(1)[:,2]
         # Some estimated angles need to be negated, again not sure why, seems to depend on whether
         # orientation sequences are even or odd
         if negAngleIdx==0: r1= -r1
         if negAngleIdx==1: r2= -r2
         r3 = -r3
+        valid = (np.abs(r1)<=45) & (np.abs(r2)<=np.abs(r1))
+        result = np.zeros(valid.sum(), dtype=PROTOCOL_DTYPE)
+        result['index'] = index[valid]
+        result['orientation'] = orientation
+        result['position'] = position[index[valid]]
+        result['rot1'], result['rot2'] = rot1Str, rot2Str
+        result['angle1'], result['angle2'] = r1[valid], r2[valid]
         # different "jumps" in PE orientation result in the same image position,
         # only changing how it is acquired (e.g. A>>P, R>>L, P>>A, ...)
-        r3Alternatives = (np.mod(r3 + np.array([0, 90, -90, 180]) + 180, 360) -180).round(1)
-        xStr = 'L' if dX>=0 else 'R'
-        yStr = 'P' if dY>=0 else 'A'
-        zStr = 'H' if dZ>=0 else 'F'
-        if abs(r1)<=45 and abs(r2)<=abs(r1):
-            print(f"{xStr}{abs(dX)} {yStr}{abs(dY)} {zStr}{abs(dZ)} " +
-                  f"{rot1Str} {r1} {rot2Str} {r2}; possible PE orientations: {*r3Alternatives,}")
-
-def loadFromDicomExport(dicomExportPath, seriesNumber):
+        result['peAngles'] = (np.mod(r3[valid,None] + np.array([0, 90, -90, 180]) + 180, 360) -180).round(1)
+        rows.append(result)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=PROTOCOL_DTYPE)
+    return rows[np.lexsort((rows['orientation'], rows['index']))]
+
+def siemensProtocol2qform(position,orientation,angle1,angle2,peAngle,dims,voxelSizes):
+    # inverse of qform2SiemensProtocolBatch: builds the qforms from the Siemens protocol parameters,
+    # position (dX, dY, dZ) in LPH, orientation an index into ORIENTATIONS, angle1/angle2 the tilts
+    # named by its rot1/rot2, peAngle the PE angle. All arguments are broadcast to N entries,
+    # returns a (N,4,4) stack of qforms.
+    position, dims, voxelSizes = [np.atleast_2d(np.asarray(x, dtype=float))
+                                  for x in (position, dims, voxelSizes)]
+    orientation, angle1, angle2, peAngle = [np.atleast_1d(np.asarray(x)) for x in
+                                            (orientation, angle1, angle2, peAngle)]
+    N = max(len(x) for x in (position, orientation, angle1, angle2, peAngle, dims, voxelSizes))
+    position, dims, voxelSizes = [np.broadcast_to(x, (N,3)) for x in (position, dims, voxelSizes)]
+    orientation, angle1, angle2, peAngle = [np.broadcast_to(x, (N,)) for x in
+                                            (orientation, angle1, angle2, peAngle)]
+    nI, nJ, nK = dims.T
+    NV2DV = np.tile(np.diag([1.,-1,1,1]), (N,1,1))
+    NV2DV[:,1,3] = nJ-1
+    DS2NS = np.diag([-1.,-1,1,1])
+    dVoxel = np.zeros((N,4,4))
+    dVoxel[:,[0,1,2,3],[0,1,2,3]] = np.c_[voxelSizes, np.ones(N)]
+    centerSlab = np.tile(np.eye(4), (N,1,1))
+    centerSlab[:,:3,3] = np.stack([-nI/2, -nJ/2, -(nK/2-0.5)], axis=1)
+    qforms = np.zeros((N,4,4))
+    for o, (rotOrder, peEstRotOrder, _, _, initialOrientation, negAngleIdx) in enumerate(ORIENTATIONS):
+        idx = np.flatnonzero(orientation == o)
+        if len(idx) == 0:
+            continue
+        # undo the negations of qform2SiemensProtocolBatch
+        r1 = -angle1[idx] if negAngleIdx==0 else angle1[idx]
+        r2 = -angle2[idx] if negAngleIdx==1 else angle2[idx]
+        r3 = -peAngle[idx]
+        if any(peEstRotOrder):
+            # 1st two angles are defined in rotOrder, the PE angle in peEstRotOrder, both end
+            # with a rotation around the same axis, so the PE angle is a rotation around that axis
+            # starting from the orientation given by the 1st two angles
+            rot0 = Rotation.from_euler(rotOrder, np.c_[r1, r2, np.zeros(len(idx))], degrees=True)
+            r3_0 = rot0.as_euler(peEstRotOrder, degrees=True)[:,2]
+            rot = rot0 * Rotation.from_euler(rotOrder[2], (r3 - r3_0)[:,None], degrees=True)
+        else:
+            rot = Rotation.from_euler(rotOrder, np.c_[r1, r2, r3], degrees=True)
+        dLPH_R = np.tile(np.eye(4), (len(idx),1,1))
+        dLPH_R[:,:3,:3] = rot.as_matrix()
+        dLPH_R[:,:3,3] = position[idx]
+        IO = initialOrientation @ dVoxel[idx] @ centerSlab[idx]
+        qforms[idx] = DS2NS @ dLPH_R @ IO @ NV2DV[idx]
+    return qforms
+
+# wall time per pipeline stage in seconds, collected by timedStage while this is a dict
+# (see asrs_phantom_bench.py)
+stageTimings = None
+
+@contextlib.contextmanager
+def timedStage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stageTimings is not None:
+            stageTimings[name] = stageTimings.get(name, 0.0) + time.perf_counter() - start
+
+def formatSiemensProtocol(row):
+    # one row of qform2SiemensProtocolBatch as printed by qform2SiemensProtocol
+    dX, dY, dZ = row['position']
+    xStr = 'L' if dX>=0 else 'R'
+    yStr = 'P' if dY>=0 else 'A'
+    zStr = 'H' if dZ>=0 else 'F'
+    return (f"{xStr}{abs(dX)} {yStr}{abs(dY)} {zStr}{abs(dZ)} " +
+            f"{row['rot1']} {row['angle1']} {row['rot2']} {row['angle2']}; " +
+            f"possible PE orientations: {tuple(float(a) for a in row['peAngles'])}")
+
+def qform2SiemensProtocol(qform,dims):
+    # prints the Siemens protocol parameters for a single qform (see qform2SiemensProtocolBatch),
+    # returned as list of ((dX, dY, dZ), rot1Str, r1, rot2Str, r2, r3Alternatives)
+    results = []
+    for row in qform2SiemensProtocolBatch(qform, dims):
+        print(formatSiemensProtocol(row))
+        results.append((tuple(float(d) for d in row['position']), str(row['rot1']), float(row['angle1']),
+                        str(row['rot2']), float(row['angle2']), row['peAngles']))
+    return results
+
+def loadFromDicomExport(dicomExportPath, seriesNumber, files=None):
+    # conversions are cached (asrs_cache) under the content of the files of the series, files
+    # as listed by dicom_series_selector; without them, the series is looked up only in an
+    # already stored header index, a cold export is converted without the cache
+    import asrs_cache
+    from dicom_series_selector import DicomHeaderIndex, find_series
+    cache = asrs_cache.ContentCache()
+    if cache.enabled and files is None:
+        index = DicomHeaderIndex(dicomExportPath)
+        if index.entries:
+            index.refresh()
+            files = find_series(index.series_dict(), seriesNumber)
+    if not cache.enabled or (files and not isinstance(files[0], tuple)):
+        # the key needs the headers of the files
+        files = None
+    entry = None
+    # the files are only hashed if an entry of the series can exist
+    if files is not None and cache.hasPrefix(asrs_cache.seriesPrefix(files)):
+        entry = cache.get(asrs_cache.seriesKey(files))
+    if entry is not None:
+        with open(os.path.join(entry, 'converted.json')) as f:
+            converted = [os.path.join(entry, name) for name in json.load(f)]
+        return converted[0] if len(converted) == 1 else converted
+    # nipype is only imported where it is used, it dominates the start-up time
+    from nipype.interfaces.dcm2nii import Dcm2niix
     logging.getLogger('nipype.interface').setLevel(0)
     converter = Dcm2niix(source_dir=dicomExportPath, compress='n', args="-n " + str(seriesNumber))
-    converter_results = converter.run()
-    return converter_results.outputs.converted_files
+    with timedStage('dcm2niix'):
+        converter_results = converter.run()
+    converted = converter_results.outputs.converted_files
+    if files is not None:
+        # hashed after dcm2niix has read the files, from the page cache
+        paths = [converted] if isinstance(converted, str) else converted
+        cache.put(asrs_cache.seriesKey(files), paths, {'converted': [os.path.basename(path) for path in paths]})
+    return converted
+
+def loadFromDicomSeries(files):
+    # Assembles a nifti image in memory from the files of one series, as listed by
+    # dicom_series_selector ((file_path, header) tuples or plain paths). Voxel order
+    # follows dcm2niix (i: columns, j: rows flipped, k: slices) so that qform2SiemensProtocol
+    # can be used on the result.
+    with timedStage('dicom conversion'):
+        return _loadFromDicomSeries(files)
 
-def registerOldSlabToNewRef(slab1,ref1,ref2):
+def _loadFromDicomSeries(files):
+    import pydicom
+    from nibabel.nicom.dicomwrappers import wrapper_from_data
+    paths = sorted(f[0] if isinstance(f, tuple) else f for f in files)
+    wrappers = [wrapper_from_data(pydicom.dcmread(path)) for path in paths]
+    if wrappers[0].is_mosaic or wrappers[0].is_multiframe:
+        # every file holds a complete volume (row, column, slice)
+        wrappers.sort(key=lambda w: w.instance_number or 0)
+        volumes = [w.get_data() for w in wrappers]
+        affine = wrappers[0].affine
+        data = np.stack(volumes, axis=3) if len(volumes) > 1 else volumes[0]
+    else:
+        # one slice per file, files at the same position are successive volumes; slices follow
+        # the DICOM slice normal (row x column) like in dcm2niix. nibabel's slice_indicator is
+        # not used, its sign depends on the wrapper (CSA SliceNormalVector for Siemens files).
+        iop = np.array(wrappers[0].get('ImageOrientationPatient'), dtype=float)
+        normal = np.cross(iop[:3], iop[3:])
+        def position(w):
+            return round(float(np.dot(normal, w.image_position)), 3)
+        wrappers.sort(key=lambda w: (position(w), w.instance_number or 0))
+        positions = sorted(set(position(w) for w in wrappers))
+        nS, nV = len(positions), len(wrappers) // len(positions)
+        if nS * nV != len(wrappers):
+            raise ValueError(f"Incomplete series: {len(wrappers)} files for {nS} slice positions")
+        slices = np.stack([w.get_data() for w in wrappers], axis=2)
+        data = slices.reshape(slices.shape[:2] + (nS, nV))
+        if nV == 1:
+            data = data[..., 0]
+        affine = wrappers[0].affine
+        if nS > 1:
+            first, last = wrappers[0], wrappers[-1]
+            affine[:3, 2] = (np.array(last.image_position) - np.array(first.image_position)) / (nS - 1)
+        else:
+            affine[:3, 2] = normal * np.linalg.norm(affine[:3, 2])
+    # (row, column, slice) in LPS -> (column, flipped row, slice) in RAS
+    nRows = data.shape[0]
+    P = np.array([[ 0, -1,  0, nRows - 1 ],
+                  [ 1,  0,  0,         0 ],
+                  [ 0,  0,  1,         0 ],
+                  [ 0,  0,  0,         1 ]])
+    affine = np.diag([-1, -1, 1, 1]) @ affine @ P
+    data = np.swapaxes(data, 0, 1)[:, ::-1]
+    img = nb.Nifti1Image(np.ascontiguousarray(data, dtype=np.float32), affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    return img
+
+def loadSelectedSeries(dicomExportPath, seriesNumber, files):
+    # converts an already selected series in-process, dcm2niix on the whole export is the fallback
+    try:
+        return loadFromDicomSeries(files)
+    except Exception as e:
+        print(f"In-process conversion failed ({e}), falling back to dcm2niix...")
+        return loadFromDicomExport(dicomExportPath, seriesNumber, files)
+
+def registerInMemory(slab1,ref1,ref2,bundle=None,cropMargin=None,multiStart=False):
+    # FLIRT chain of registerOldSlabToNewRef without intermediate files in the working directory:
+    # volume extraction, qform resampling and matrix algebra are done in-process, only the two FLIRT
+    # registrations get their inputs and outputs through a private (tmpfs) scratch directory.
+    # With a session 1 bundle (asrs_bundle), slab1 and ref1 are not used.
+    import asrs_native
+    from nipype.interfaces.fsl import FLIRT, FSLCommand
     FSLCommand.set_default_output_type('NIFTI')
-    extractVolume_result = ExtractROI(in_file=slab1, t_min=0, t_size=1).run()
-    slab1 = extractVolume_result.outputs.roi_file
-    ref1_to_slab1_result = FLIRT(in_file=ref1, reference=slab1, out_file='ref1_in_slab1.nii',
-                                 uses_qform=True, apply_xfm=True, out_matrix_file="ref1_to_slab1.txt").run()
-    ref1_to_ref2_result = FLIRT(in_file=ref1, reference=ref2, out_file='ref1_in_ref2.nii', 
-                                out_matrix_file="ref1_to_ref2.txt", cost_func='corratio', dof=6).run()
-    invert_ref1_to_slab1_result = ConvertXFM(in_file=ref1_to_slab1_result.outputs.out_matrix_file,
-                                             out_file='slab1_to_ref1.txt',
-                                             invert_xfm=True).run()
-    concat_slab1_to_ref1_to_ref2_result = ConvertXFM(in_file=invert_ref1_to_slab1_result.outputs.out_file,
-                                                     in_file2=ref1_to_ref2_result.outputs.out_matrix_file,
-                                                     out_file="slab1_to_ref2_init.txt",
-                                                     concat_xfm=True).run()
-    ref1_slab_to_ref2_result = FLIRT(in_file=ref1_to_slab1_result.outputs.out_file,
-                                     reference=ref2,out_file='ref1_slab_in_ref2.nii',
-                                     in_matrix_file=concat_slab1_to_ref1_to_ref2_result.outputs.out_file,
-                                     out_matrix_file="slab1_to_ref2.txt",
-                                     cost_func='corratio',dof=6, no_search=True).run()    
-    xform = np.matrix(np.loadtxt(ref1_slab_to_ref2_result.outputs.out_matrix_file))
+    if bundle is None:
+        with timedStage('extract slab volume'):
+            img_slab1, img_ref1 = [asrs_native.firstVolume(loadImage(img)) for img in (slab1, ref1)]
+        with timedStage('ref1 to slab1'):
+            ref1_to_slab1 = asrs_native.qformMatrix(img_ref1, img_slab1)
+            ref1_in_slab1 = asrs_native.resample(img_ref1, img_slab1, ref1_to_slab1)
+    else:
+        ref1, ref1_in_slab1 = bundle.ref1, bundle.ref1InSlab
+        ref1_to_slab1 = asrs_native.qformMatrix(ref1, ref1_in_slab1)
+    with tempfile.TemporaryDirectory(prefix='asrs_', dir=scratchParent()) as scratch:
+        def scratchFile(name):
+            return os.path.join(scratch, name)
+        ref1 = imageFile(ref1, scratchFile('ref1.nii'))
+        img_ref2 = loadImage(ref2)
+        ref2 = imageFile(ref2, scratchFile('ref2.nii'))
+        with timedStage('ref1 to ref2'):
+            if multiStart:
+                import asrs_multistart
+                ref1_to_ref2 = asrs_multistart.bestRegistration(ref1, img_ref2, 'flirt')
+            else:
+                ref1_to_ref2_result = FLIRT(in_file=ref1, reference=ref2, out_file=scratchFile('ref1_in_ref2.nii'),
+                                            out_matrix_file=scratchFile('ref1_to_ref2.txt'),
+                                            cost_func='corratio', dof=6).run()
+                ref1_to_ref2 = np.loadtxt(ref1_to_ref2_result.outputs.out_matrix_file)
+        slab1_to_ref2_init = ref1_to_ref2 @ np.linalg.inv(ref1_to_slab1)
+        xform = flirtFineTune(ref1_in_slab1, img_ref2, ref2, slab1_to_ref2_init, cropMargin)
     return xform
 
+def flirtFineTune(ref1_in_slab1, img_ref2, ref2File, slab1_to_ref2_init, cropMargin=None):
+    # final FLIRT of the slab-sampled ref1 (in-memory image) to ref2 (image and its file),
+    # starting from slab1_to_ref2_init, in its own scratch directory
+    from nipype.interfaces.fsl import FLIRT
+    with tempfile.TemporaryDirectory(prefix='asrs_', dir=scratchParent()) as scratch:
+        def scratchFile(name):
+            return os.path.join(scratch, name)
+        crop_to_ref2 = np.eye(4)
+        if cropMargin is not None:
+            img_ref2_crop, crop_to_ref2 = cropToSlab(img_ref2, ref1_in_slab1, slab1_to_ref2_init, cropMargin)
+            slab1_to_ref2_init = np.linalg.inv(crop_to_ref2) @ slab1_to_ref2_init
+            ref2File = imageFile(img_ref2_crop, scratchFile('ref2_crop.nii'))
+        np.savetxt(scratchFile('slab1_to_ref2_init.txt'), slab1_to_ref2_init)
+        nb.save(ref1_in_slab1, scratchFile('ref1_in_slab1.nii'))
+        with timedStage('slab1 to ref2'):
+            ref1_slab_to_ref2_result = FLIRT(in_file=scratchFile('ref1_in_slab1.nii'),
+                                             reference=ref2File, out_file=scratchFile('ref1_slab_in_ref2.nii'),
+                                             in_matrix_file=scratchFile('slab1_to_ref2_init.txt'),
+                                             out_matrix_file=scratchFile('slab1_to_ref2.txt'),
+                                             cost_func='corratio',dof=6, no_search=True).run()
+        xform = np.matrix(crop_to_ref2) * np.matrix(np.loadtxt(ref1_slab_to_ref2_result.outputs.out_matrix_file))
+    return xform
+
+def registerOldSlabToNewRef(slab1,ref1,ref2,backend='flirt',inMemory=False,bundle=None,cropMargin=None,
+                           multiStart=False):
+    # backend 'flirt' runs the FSL tools, 'native' the in-process registration of asrs_native,
+    # inMemory runs the FSL tools without writing intermediate files into the working directory,
+    # bundle is precomputed session 1 data (asrs_bundle), which replaces slab1 and ref1,
+    # with cropMargin (mm) the final registration only uses the part of ref2 around the slab,
+    # multiStart registers ref1 -> ref2 from several starting points (asrs_multistart)
+    if backend == 'native':
+        import asrs_native
+        return asrs_native.registerOldSlabToNewRef(slab1, ref1, ref2, bundle, cropMargin, multiStart)
+    if backend != 'flirt':
+        raise ValueError(f"Unknown registration backend: {backend}")
+    if inMemory or bundle is not None:
+        return registerInMemory(slab1, ref1, ref2, bundle, cropMargin, multiStart)
+    import asrs_native
+    from nipype.interfaces.fsl import FLIRT, ConvertXFM, FSLCommand
+    FSLCommand.set_default_output_type('NIFTI')
+    with timedStage('extract slab volume'):
+        # in-process instead of ExtractROI, which reads and writes the whole time series
+        nb.save(asrs_native.firstVolume(nb.load(slab1)), 'slab1_roi.nii')
+    slab1 = os.path.abspath('slab1_roi.nii')
+    with timedStage('ref1 to slab1'):
+        ref1_to_slab1_result = FLIRT(in_file=ref1, reference=slab1, out_file='ref1_in_slab1.nii',
+                                     uses_qform=True, apply_xfm=True, out_matrix_file="ref1_to_slab1.txt").run()
+    with timedStage('ref1 to ref2'):
+        if multiStart:
+            import asrs_multistart
+            np.savetxt('ref1_to_ref2.txt', asrs_multistart.bestRegistration(ref1, ref2, 'flirt'))
+            ref1_to_ref2_matrix_file = os.path.abspath('ref1_to_ref2.txt')
+        else:
+            ref1_to_ref2_result = FLIRT(in_file=ref1, reference=ref2, out_file='ref1_in_ref2.nii', 
+                                        out_matrix_file="ref1_to_ref2.txt", cost_func='corratio', dof=6).run()
+            ref1_to_ref2_matrix_file = ref1_to_ref2_result.outputs.out_matrix_file
+    with timedStage('invert'):
+        invert_ref1_to_slab1_result = ConvertXFM(in_file=ref1_to_slab1_result.outputs.out_matrix_file,
+                                                 out_file='slab1_to_ref1.txt',
+                                                 invert_xfm=True).run()
+    with timedStage('concat'):
+        concat_slab1_to_ref1_to_ref2_result = ConvertXFM(in_file=invert_ref1_to_slab1_result.outputs.out_file,
+                                                         in_file2=ref1_to_ref2_matrix_file,
+                                                         out_file="slab1_to_ref2_init.txt",
+                                                         concat_xfm=True).run()
+    slab1_to_ref2_init = concat_slab1_to_ref1_to_ref2_result.outputs.out_file
+    crop_to_ref2 = np.eye(4)
+    if cropMargin is not None:
+        img_ref2_crop, crop_to_ref2 = cropToSlab(nb.load(ref2), nb.load(ref1_to_slab1_result.outputs.out_file),
+                                                 np.loadtxt(slab1_to_ref2_init), cropMargin)
+        nb.save(img_ref2_crop, 'ref2_crop.nii')
+        ref2 = 'ref2_crop.nii'
+        np.savetxt('slab1_to_ref2_crop_init.txt', np.linalg.inv(crop_to_ref2) @ np.loadtxt(slab1_to_ref2_init))
+        slab1_to_ref2_init = 'slab1_to_ref2_crop_init.txt'
+    with timedStage('slab1 to ref2'):
+        ref1_slab_to_ref2_result = FLIRT(in_file=ref1_to_slab1_result.outputs.out_file,
+                                         reference=ref2,out_file='ref1_slab_in_ref2.nii',
+                                         in_matrix_file=slab1_to_ref2_init,
+                                         out_matrix_file="slab1_to_ref2.txt",
+                                         cost_func='corratio',dof=6, no_search=True).run()    
+    xform = np.matrix(crop_to_ref2) * np.matrix(np.loadtxt(ref1_slab_to_ref2_result.outputs.out_matrix_file))
+    return xform
+
+def registerSlabsToNewRef(slabs, ref1, ref2, backend='flirt', cropMargin=None, workers=None, multiStart=False):
+    """
+    FLIRT matrices slab -> ref2 for several session 1 target boxes (slabs) sharing ref1 and ref2.
+    ref1 -> ref2 is registered only once, the fine-tuning of the targets runs in parallel
+    (threads for the FLIRT subprocesses, processes for the native backend).
+    """
+    import asrs_native
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    img_ref1, img_ref2 = [asrs_native.firstVolume(loadImage(img)) for img in (ref1, ref2)]
+    with tempfile.TemporaryDirectory(prefix='asrs_', dir=scratchParent()) as scratch:
+        ref2File = None
+        if multiStart:
+            import asrs_multistart
+            with timedStage('ref1 to ref2'):
+                ref1_to_ref2 = asrs_multistart.bestRegistration(img_ref1, img_ref2, backend, workers)
+        if backend == 'native':
+            if not multiStart:
+                with timedStage('ref1 to ref2'):
+                    ref1_to_ref2, _ = asrs_native.register(img_ref1, img_ref2)
+            executor = ProcessPoolExecutor(max_workers=workers)
+        elif backend == 'flirt':
+            from nipype.interfaces.fsl import FLIRT, FSLCommand
+            FSLCommand.set_default_output_type('NIFTI')
+            ref1File = imageFile(ref1, os.path.join(scratch, 'ref1.nii'))
+            ref2File = imageFile(ref2, os.path.join(scratch, 'ref2.nii'))
+            if not multiStart:
+                with timedStage('ref1 to ref2'):
+                    ref1_to_ref2_result = FLIRT(in_file=ref1File, reference=ref2File,
+                                                out_file=os.path.join(scratch, 'ref1_in_ref2.nii'),
+                                                out_matrix_file=os.path.join(scratch, 'ref1_to_ref2.txt'),
+                                                cost_func='corratio', dof=6).run()
+                ref1_to_ref2 = np.loadtxt(ref1_to_ref2_result.outputs.out_matrix_file)
+            executor = ThreadPoolExecutor(max_workers=workers or len(slabs))
+        else:
+            raise ValueError(f"Unknown registration backend: {backend}")
+        with executor:
+            futures = [executor.submit(_fineTuneTarget, slab, img_ref1, img_ref2, ref2File, ref1_to_ref2,
+                                       backend, cropMargin) for slab in slabs]
+            return [future.result() for future in futures]
+
+def _fineTuneTarget(slab, img_ref1, img_ref2, ref2File, ref1_to_ref2, backend, cropMargin):
+    # one target of registerSlabsToNewRef, runs in a worker thread or process
+    import asrs_native
+    ref1_in_slab, slab_mask, ref1_to_slab = asrs_native.slabReference(img_ref1, slab)
+    slab_to_ref2_init = ref1_to_ref2 @ np.linalg.inv(ref1_to_slab)
+    if backend == 'native':
+        return asrs_native.fineTuneSlab(ref1_in_slab, img_ref2, slab_to_ref2_init, slab_mask,
+                                        cropMargin=cropMargin)
+    return flirtFineTune(ref1_in_slab, img_ref2, ref2File, slab_to_ref2_init, cropMargin)
+
+def scratchParent():
+    # parent folder for private scratch directories, tmpfs if available
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def loadImage(img):
+    # nibabel image of an image given as file name or in-memory nibabel image
+    return nb.load(img) if isinstance(img, str) else img
+
+def imageFile(img, fname):
+    # file name of an image given as file name or in-memory nibabel image
+    if isinstance(img, str):
+        return img
+    nb.save(img, fname)
+    return fname
+
 def voxelToFsl(img):
     dI, dJ, dK = img.header.get_zooms()[:3]
     nI, _, _ = img.shape[:3]
@@ -117,21 +476,107 @@ def voxelToFsl(img):
 def flirtToSform(xform,srcImg,refImg):
     return refImg.affine * voxelToFsl(refImg).I * xform * voxelToFsl(srcImg)
 
+def cropToSlab(img, slab, slab_to_img, margin):
+    # img cropped to the bounding box of slab, placed by the FLIRT matrix slab_to_img, plus margin (mm);
+    # returns the cropped image and the FLIRT matrix from the cropped image to img, which converts
+    # matrices estimated against the cropped image back (so that flirtToSform with img is unchanged)
+    nI, nJ, nK = slab.shape[:3]
+    corners = np.array([[i, j, k, 1] for i in (-0.5, nI - 0.5) for j in (-0.5, nJ - 0.5)
+                        for k in (-0.5, nK - 0.5)]).T
+    voxels = np.asarray(voxelToFsl(img).I * np.matrix(slab_to_img) * voxelToFsl(slab)) @ corners
+    pad = margin / np.array(img.header.get_zooms()[:3])
+    lo = np.maximum(np.floor(voxels[:3].min(axis=1) - pad).astype(int), 0)
+    hi = np.minimum(np.ceil(voxels[:3].max(axis=1) + pad).astype(int) + 1, img.shape[:3])
+    if np.any(hi <= lo):
+        # slab outside of img, nothing sensible to crop
+        return img, np.eye(4)
+    cropped = img.slicer[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    offset = np.eye(4)
+    offset[:3, 3] = lo
+    return cropped, np.asarray(voxelToFsl(img) * np.matrix(offset) * voxelToFsl(cropped).I)
+
 def test_qform2SiemensProtocol(nifti_fname):
     img = nb.load(nifti_fname)
     qform = img.affine
     dims = img.shape[:3]
     qform2SiemensProtocol(qform,dims)
 
-def asrs(slab1, ref1, ref2):
-    xform = registerOldSlabToNewRef(slab1,ref1,ref2)
-    img_slab1 = nb.load(slab1)
-    img_ref2 = nb.load(ref2)
+def asrsMatrices(slab1, ref1, ref2, backend='flirt', inMemory=False, bundle=None, cropMargin=None,
+                 multiStart=False):
+    # registration part of asrs, returns the FSL matrix slab1 -> ref2, the sform of the
+    # slab in session 2 and the slab dimensions
+    import asrs_cache
+    if isinstance(bundle, str):
+        import asrs_bundle
+        bundle = asrs_bundle.loadBundle(bundle)
+    # registrations are cached (asrs_cache) under the content of the images and the options
+    cache = asrs_cache.ContentCache()
+    key = entry = None
+    if cache.enabled:
+        key = asrs_cache.registrationKey(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin,
+                                             multiStart)
+        entry = cache.get(key)
+    if entry is not None:
+        with open(os.path.join(entry, 'xform.json')) as f:
+            xform = np.matrix(json.load(f))
+    elif backend == 'native' or inMemory or bundle is not None:
+        xform = registerOldSlabToNewRef(slab1,ref1,ref2,backend,inMemory,bundle,cropMargin,multiStart)
+    else:
+        with tempfile.TemporaryDirectory(prefix='asrs_', dir=scratchParent()) as scratch:
+            xform = registerOldSlabToNewRef(slab1,ref1,imageFile(ref2, os.path.join(scratch, 'ref2.nii')),
+                                            backend,cropMargin=cropMargin,multiStart=multiStart)
+    if entry is None and key is not None:
+        cache.put(key, data={'xform': np.asarray(xform).tolist()})
+    # only the header of slab1 is read (shape and geometry)
+    img_slab1 = nb.load(slab1) if bundle is None else bundle.ref1InSlab
+    img_ref2 = loadImage(ref2)
     dims=img_slab1.shape[:3]
     sform = flirtToSform(xform,img_slab1,img_ref2) 
-    qform2SiemensProtocol(sform,dims)
+    return xform, sform, dims
+
+def asrs(slab1, ref1, ref2, backend='flirt', inMemory=False, bundle=None, cropMargin=None, multiStart=False):
+    # ref2 can be a file name or an in-memory image (e.g. from loadFromDicomSeries),
+    # bundle a session 1 bundle or its file name (see asrs_bundle), slab1 and ref1 are then not used
+    _, sform, dims = asrsMatrices(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin, multiStart)
+    with timedStage('protocol'):
+        return qform2SiemensProtocol(sform,dims)
+
+def asrsMulti(slabs, ref1, ref2, backend='flirt', cropMargin=None, workers=None, multiStart=False):
+    # asrs for several target boxes at once (see registerSlabsToNewRef), prints one report
+    # and returns the qform2SiemensProtocol results per target
+    xforms = registerSlabsToNewRef(slabs, ref1, ref2, backend, cropMargin, workers, multiStart)
+    img_ref2 = loadImage(ref2)
+    results = []
+    for i, (slab, xform) in enumerate(zip(slabs, xforms)):
+        img_slab = loadImage(slab)
+        print(f"{slab if isinstance(slab, str) else f'target {i + 1}'}:")
+        with timedStage('protocol'):
+            results.append(qform2SiemensProtocol(flirtToSform(xform, img_slab, img_ref2), img_slab.shape[:3]))
+    return results
+
+def popOption(argv, name, default=None):
+    # removes "name value" from the argument list argv and returns value
+    if name not in argv:
+        return default
+    idx = argv.index(name)
+    value = argv[idx+1]
+    del argv[idx:idx+2]
+    return value
+
+def popFlag(argv, name):
+    # removes flag name from the argument list argv and returns whether it was given
+    if name not in argv:
+        return False
+    argv.remove(name)
+    return True
     
 if __name__ == "__main__":
+    backend = popOption(sys.argv, '--backend', 'flirt')
+    inMemory = popFlag(sys.argv, '--in-memory')
+    bundle = popOption(sys.argv, '--bundle')
+    cropMargin = popOption(sys.argv, '--crop-margin')
+    cropMargin = float(cropMargin) if cropMargin is not None else None
+    multiStart = popFlag(sys.argv, '--multi-start')
     if len(sys.argv)==2:
         test_qform2SiemensProtocol(sys.argv[1])
     else:
@@ -144,4 +589,4 @@ if __name__ == "__main__":
             ref1 = 'ref1.nii'
             slab1 = 'slab1.nii'
         ref2 = loadFromDicomExport(dicomExportPath, seriesNumber)
-        asrs(slab1, ref1, ref2)
+        asrs(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin, multiStart)
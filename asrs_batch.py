@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+""" Retrospective batch mode of ASRS for an archive of sessions.
+
+The manifest is a CSV file with the columns session, slab1, ref1 and ref2 (one row per
+session, relative paths are relative to the manifest). Sessions are processed in parallel
+in a process pool, each in its own scratch directory, and the results are appended to a
+single CSV table as sessions finish: one row per reported orientation type with the
+protocol parameters, the FSL matrix slab1 -> ref2 and the resulting slab sform.
+
+An interrupted run is resumed by running the same command again: sessions that already
+have a successful row in the results table are skipped, failed sessions are retried.
+
+Usage: asrs_batch.py manifest.csv results.csv [--workers N] [--backend flirt|native] [--in-memory]
+                     [--crop-margin MM] [--multi-start]
+"""
+import argparse
+import csv
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+RESULT_FIELDS = ['session', 'status', 'error', 'seconds', 'orientation', 'position_x', 'position_y',
+                 'position_z', 'rot1', 'angle1', 'rot2', 'angle2', 'pe_angles', 'xform', 'sform']
+
+def readManifest(manifest):
+    # list of (session, slab1, ref1, ref2) with absolute paths
+    base = os.path.dirname(os.path.abspath(manifest))
+    sessions = []
+    with open(manifest, newline='') as f:
+        for row in csv.DictReader(f):
+            paths = [os.path.join(base, row[name].strip()) for name in ('slab1', 'ref1', 'ref2')]
+            sessions.append((row['session'].strip(), *paths))
+    names = [session for session, *_ in sessions]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Duplicate sessions in {manifest}: {', '.join(duplicates)}")
+    return sessions
+
+def completedSessions(results):
+    # sessions with a successful row in an existing results table
+    if not os.path.exists(results):
+        return set()
+    with open(results, newline='') as f:
+        return set(row['session'] for row in csv.DictReader(f) if row['status'] == 'ok')
+
+def formatMatrix(M):
+    return ' '.join(f"{float(x):.6f}" for x in M.flat)
+
+def scratchPrefix(session):
+    # session names come from the manifest, only safe characters go into the directory name
+    return f"asrs_{re.sub(r'[^A-Za-z0-9._-]', '_', session)[:64]}_"
+
+def failedSession(session, start, error):
+    return [{'session': session, 'status': 'failed', 'seconds': f"{time.perf_counter() - start:.1f}",
+             'error': error}]
+
+def runSession(session, slab1, ref1, ref2, backend, inMemory, cropMargin, multiStart=False):
+    # runs in a worker process, the FLIRT chain writes its files into the current
+    # directory, so every session gets a private one; always returns at least one row
+    import asrs
+    start = time.perf_counter()
+    try:
+        with tempfile.TemporaryDirectory(prefix=scratchPrefix(session), dir=asrs.scratchParent()) as scratch:
+            os.chdir(scratch)
+            try:
+                xform, sform, dims = asrs.asrsMatrices(slab1, ref1, ref2, backend, inMemory,
+                                                         cropMargin=cropMargin, multiStart=multiStart)
+                rows = asrs.qform2SiemensProtocolBatch(sform, dims)
+            finally:
+                os.chdir('/')
+    except Exception as e:
+        return failedSession(session, start, ''.join(traceback.format_exception_only(type(e), e)).strip())
+    if not len(rows):
+        return failedSession(session, start, "no protocol position for the resulting slab geometry")
+    seconds = f"{time.perf_counter() - start:.1f}"
+    return [{'session': session, 'status': 'ok', 'error': '', 'seconds': seconds,
+             'orientation': int(row['orientation']),
+             'position_x': float(row['position'][0]), 'position_y': float(row['position'][1]),
+             'position_z': float(row['position'][2]),
+             'rot1': str(row['rot1']), 'angle1': float(row['angle1']),
+             'rot2': str(row['rot2']), 'angle2': float(row['angle2']),
+             'pe_angles': ' '.join(str(float(a)) for a in row['peAngles']),
+             'xform': formatMatrix(xform), 'sform': formatMatrix(sform)} for row in rows]
+
+def runBatch(manifest, results, workers=None, backend='flirt', inMemory=False, cropMargin=None,
+             multiStart=False):
+    """
+    Process all sessions of manifest that are not yet in results, returns the number of
+    failed sessions.
+    """
+    sessions = readManifest(manifest)
+    done = completedSessions(results)
+    todo = [s for s in sessions if s[0] not in done]
+    print(f"{len(sessions)} sessions, {len(sessions) - len(todo)} already done, {len(todo)} to run")
+    failed = 0
+    newFile = not os.path.exists(results)
+    with open(results, 'a', newline='') as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if newFile:
+            writer.writeheader()
+        futures = {executor.submit(runSession, *session, backend, inMemory, cropMargin, multiStart): session[0]
+                   for session in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            rows = future.result()
+            writer.writerows(rows)
+            # every finished session is on disk, so an interrupted batch can be resumed
+            f.flush()
+            os.fsync(f.fileno())
+            status = rows[0]['status']
+            failed += status != 'ok'
+            print(f"[{n}/{len(todo)}] {futures[future]}: {status} ({rows[0]['seconds']} s)" +
+                  (f" {rows[0]['error']}" if status != 'ok' else ''))
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run ASRS over all sessions of a manifest.')
+    parser.add_argument('manifest', help='CSV file with columns session, slab1, ref1, ref2')
+    parser.add_argument('results', help='CSV results table, appended to and used to resume')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--backend', default='flirt', choices=['flirt', 'native'])
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Run the FLIRT chain without intermediate files')
+    parser.add_argument('--crop-margin', type=float, default=None,
+                        help='Crop ref2 to the slab plus this margin (mm) for the final registration')
+    parser.add_argument('--multi-start', action='store_true',
+                        help='Register ref1 to ref2 from several starting points and use the best')
+    args = parser.parse_args()
+    if runBatch(args.manifest, args.results, args.workers, args.backend, args.in_memory,
+                args.crop_margin, args.multi_start):
+        sys.exit(1)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+""" Precomputed session 1 data ("subject bundle") for ASRS.
+
+Everything asrs needs from session 1 (slab geometry, ref1 resampled into the slab and its
+coverage mask, the reference volume itself, which for MP2RAGE is the brain masked UNI, and
+the registration pyramid of the slab for the native backend) is computed ahead of time by
+
+    asrs_bundle.py prepare slab1.nii ref1.nii [bundle.npz]
+    asrs_bundle.py prepare slab1.nii uni_ses1.nii --inv2 inv2_ses1.nii [bundle.npz]
+
+so that on scan day only the session 2 side has to be processed.
+"""
+import sys
+import json
+import hashlib
+import numpy as np
+import nibabel as nb
+import asrs
+import asrs_native
+
+# bump when the content or the meaning of the stored arrays changes
+BUNDLE_VERSION = 2
+DEFAULT_BUNDLE = 'asrs_bundle.npz'
+
+def fileHash(fname, blockSize=1 << 22):
+    # sha256 of the file content
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class SubjectBundle:
+    """
+    Session 1 data of one subject as needed by asrs.asrs.
+
+    ref1 is the reference volume (nibabel image), ref1InSlab the reference resampled into
+    the first slab volume (it has the geometry of slab1 and replaces it in flirtToSform),
+    slabMask the voxels of the slab covered by ref1.
+    """
+    def __init__(self, ref1, ref1InSlab, slabMask, pyramids=None, metadata=None):
+        self.ref1 = ref1
+        self.ref1InSlab = ref1InSlab
+        self.slabMask = slabMask
+        self.pyramids = pyramids or {}
+        self.metadata = metadata or {}
+
+    @property
+    def id(self):
+        return self.metadata.get('id')
+
+    def pyramid(self, name):
+        # precomputed pyramid (only ref1InSlab) if it matches the current native schedule
+        if self.metadata.get('schedule') != [list(level) for level in asrs_native.SCHEDULE]:
+            return None
+        return self.pyramids.get(name)
+
+def _image(data, affine, zooms):
+    img = nb.Nifti1Image(data, affine)
+    img.header.set_zooms(tuple(zooms))
+    return img
+
+def prepareBundle(slab1, ref1, inv2=None):
+    """
+    Compute the bundle from slab1 and ref1 (file names). If inv2 is given, ref1 is the
+    session 1 UNI image, which is masked using BET on inv2 as in asrs_mp2rage.
+    """
+    from dicom_series_selector import reference_series_info
+    inputs = {'slab1': fileHash(slab1), 'ref1': fileHash(ref1)}
+    protocol_name, sequence_name = reference_series_info(ref1)
+    ref1Shape = list(nb.load(ref1).shape)
+    if inv2 is not None:
+        import asrs_mp2rage
+        inputs['inv2'] = fileHash(inv2)
+        ref1 = asrs_mp2rage.generate_mp2rage_ref(inv2, ref1)
+    img_slab1 = asrs_native.firstVolume(nb.load(slab1))
+    img_ref1 = nb.load(ref1)
+    ref1_to_slab1 = asrs_native.qformMatrix(img_ref1, img_slab1)
+    ref1InSlab = asrs_native.resample(img_ref1, img_slab1, ref1_to_slab1)
+    ref1InSlab.header.set_zooms(img_slab1.header.get_zooms()[:3])
+    slabMask = asrs_native.coverageMask(img_ref1, img_slab1, ref1_to_slab1)
+    ref1 = _image(np.asarray(img_ref1.dataobj, dtype=np.float32), img_ref1.affine,
+                  img_ref1.header.get_zooms()[:3])
+    # the levels are full size smoothed copies: only the small slab pyramid is stored, one of
+    # ref1 would take as long to load as it takes to compute
+    pyramids = {'ref1InSlab': asrs_native.pyramid(ref1InSlab)}
+    metadata = {'version': BUNDLE_VERSION,
+                'inputs': inputs,
+                'mp2rage': inv2 is not None,
+                # to recognize the session 2 reference (asrs_watch.py)
+                'protocol': protocol_name,
+                'sequence': sequence_name,
+                'ref1Shape': ref1Shape,
+                'schedule': [list(level) for level in asrs_native.SCHEDULE]}
+    metadata['id'] = hashlib.sha256(json.dumps([metadata['version'], inputs, metadata['mp2rage']],
+                                               sort_keys=True).encode()).hexdigest()
+    return SubjectBundle(ref1, ref1InSlab, slabMask, pyramids, metadata)
+
+def saveBundle(bundle, fname):
+    arrays = {'metadata': np.array(json.dumps(bundle.metadata)),
+              'slabMask': bundle.slabMask}
+    for name in ['ref1', 'ref1InSlab']:
+        img = getattr(bundle, name)
+        arrays[name] = np.asarray(img.dataobj, dtype=np.float32)
+        arrays[name + '_affine'] = img.affine
+        arrays[name + '_zooms'] = np.array(img.header.get_zooms()[:3])
+        for level, data in enumerate(bundle.pyramids.get(name, [])):
+            arrays[f"{name}_pyramid{level}"] = data
+    # uncompressed, loading speed matters more than size
+    np.savez(fname, **arrays)
+
+def loadBundle(fname):
+    with np.load(fname, allow_pickle=False) as stored:
+        metadata = json.loads(str(stored['metadata']))
+        if metadata.get('version') != BUNDLE_VERSION:
+            raise ValueError(f"{fname} has bundle version {metadata.get('version')}, " +
+                             f"expected {BUNDLE_VERSION}, please run asrs_bundle.py prepare again")
+        images, pyramids = {}, {}
+        for name in ['ref1', 'ref1InSlab']:
+            images[name] = _image(stored[name], stored[name + '_affine'], stored[name + '_zooms'])
+            if f"{name}_pyramid0" in stored:
+                pyramids[name] = [stored[f"{name}_pyramid{level}"]
+                                  for level in range(len(metadata['schedule']))]
+        return SubjectBundle(images['ref1'], images['ref1InSlab'], stored['slabMask'],
+                             pyramids, metadata)
+
+if __name__ == "__main__":
+    inv2 = asrs.popOption(sys.argv, '--inv2')
+    if len(sys.argv) not in [4, 5] or sys.argv[1] != 'prepare':
+        print("Usage: asrs_bundle.py prepare slab1.nii ref1.nii [bundle.npz]")
+        print("or: asrs_bundle.py prepare slab1.nii uni_ses1.nii --inv2 inv2_ses1.nii [bundle.npz]")
+        sys.exit(1)
+    slab1, ref1 = sys.argv[2:4]
+    fname = sys.argv[4] if len(sys.argv) == 5 else DEFAULT_BUNDLE
+    bundle = prepareBundle(slab1, ref1, inv2)
+    saveBundle(bundle, fname)
+    print(f"Saved bundle {bundle.id[:12]} to {fname}")
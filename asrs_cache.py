@@ -0,0 +1,145 @@
+""" Content-addressed cache of DICOM conversions and registration results.
+
+Entries live in the ASRS cache directory (dicom_series_selector.cache_dir) under a key
+computed from the content of their inputs, so a repeated run with unchanged data reuses
+them and changed data can never hit a stale entry:
+
+- dcm2niix conversions (asrs.loadFromDicomExport): SeriesInstanceUID and the hash of
+  the names and contents of the files of the series,
+- registrations (asrs.asrsMatrices): the hashes of the images (geometry and data of the
+  first volume) or the session 1 bundle id, and the registration options.
+
+The total size is bounded (ASRS_CACHE_MAX_MB, default 2048 MB, 0 disables the cache);
+the least recently used entries are evicted first.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from dicom_series_selector import cache_dir
+
+# bump when the meaning of cached entries changes
+CACHE_VERSION = 1
+DEFAULT_MAX_MB = 2048
+
+def _hash(*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+def fileSetHash(paths, blockSize=1 << 22):
+    # hash of the names and contents of a set of files
+    sha = hashlib.sha256()
+    for path in sorted(paths):
+        sha.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blockSize), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def imageHash(img):
+    # hash of what a registration uses of an image: geometry and data of the first volume
+    import asrs
+    import asrs_native
+    img = asrs_native.firstVolume(asrs.loadImage(img))
+    data = np.ascontiguousarray(img.dataobj, dtype=np.float32)
+    return _hash(np.asarray(img.affine, dtype=np.float64).tobytes(), img.shape,
+                 tuple(float(z) for z in img.header.get_zooms()[:3]), data.tobytes())
+
+def seriesPrefix(files):
+    # common start of the cache keys of all conversions of a series, cheap to compute
+    series_uid = getattr(files[0][1], 'SeriesInstanceUID', None)
+    return _hash('series', CACHE_VERSION, series_uid)[:16]
+
+def seriesKey(files):
+    # cache key of the conversion of one series, files as listed by DicomHeaderIndex.series_dict
+    return seriesPrefix(files) + '-' + _hash('series', CACHE_VERSION, fileSetHash(path for path, _ in files))
+
+def registrationKey(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin, multiStart=False):
+    inputs = [bundle.id] if bundle is not None else [imageHash(slab1), imageHash(ref1)]
+    options = [backend, inMemory, cropMargin] + (['multi-start'] if multiStart else [])
+    return _hash('registration', CACHE_VERSION, *inputs, imageHash(ref2), *options)
+
+class ContentCache:
+    """
+    Directory of cache entries (one subdirectory of files per key), size-bounded with
+    least recently used eviction. The modification time of an entry is its last use.
+    """
+    def __init__(self, root=None, maxBytes=None):
+        self.root = root or os.path.join(cache_dir(), 'store')
+        if maxBytes is None:
+            maxBytes = int(float(os.environ.get('ASRS_CACHE_MAX_MB', DEFAULT_MAX_MB)) * 2**20)
+        self.maxBytes = maxBytes
+
+    @property
+    def enabled(self):
+        return self.maxBytes > 0
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def hasPrefix(self, prefix):
+        # whether any entry key starts with prefix
+        try:
+            return any(name.startswith(prefix) and not name.endswith('.tmp') for name in os.listdir(self.root))
+        except OSError:
+            return False
+
+    def get(self, key):
+        # directory of the entry or None, marks the entry as used
+        entry = self._entry(key)
+        if not self.enabled or not os.path.isdir(entry):
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        return entry
+
+    def put(self, key, files=None, data=None):
+        """
+        Store the given files (copied) and data (dict name -> JSON serializable value,
+        written as name.json) under key, returns the directory of the entry.
+        """
+        if not self.enabled:
+            return None
+        os.makedirs(self.root, exist_ok=True)
+        entry = self._entry(key)
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for path in files or []:
+            shutil.copy(path, tmp)
+        for name, value in (data or {}).items():
+            with open(os.path.join(tmp, name + '.json'), 'w') as f:
+                json.dump(value, f)
+        try:
+            # an entry appears completely or not at all
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another run, with the same content
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def evict(self):
+        # removes least recently used entries until the cache fits into maxBytes
+        entries = []
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+""" Thin client of the resident ASRS service (asrs_daemon.py).
+
+Only uses the standard library, so it starts instantly; all work is done by the daemon.
+Paths are sent as absolute paths, the daemon has its own working directory.
+
+Usage:
+    asrs_client.py asrs dicomPath seriesNumber [ref1.nii slab1.nii] [--bundle bundle.npz]
+                   [--backend flirt|native] [--in-memory] [--crop-margin MM] [--multi-start]
+    asrs_client.py gui dicomPath [ref1.nii slab1.nii] [--bundle bundle.npz]
+                   [--backend flirt|native] [--in-memory] [--crop-margin MM] [--multi-start]
+    asrs_client.py mp2rage dicomPathINV2 seriesNumberINV2 [dicomPathUNI] seriesNumberUNI
+                   [inv2_ses1.nii uni_ses1.nii slab1.nii | --bundle bundle.npz]
+                   [--backend flirt|native] [--multi-start]
+    asrs_client.py protocol scan.nii
+    asrs_client.py convert dicomPath seriesNumber out.nii
+    asrs_client.py series dicomPath
+    asrs_client.py ping | shutdown
+    (all with [--socket path], default: $ASRS_SOCKET or asrs.sock in the ASRS cache)
+"""
+import os
+import sys
+import json
+import socket
+from asrs_daemon import default_socket_path
+
+def request(job, socket_path=None, **arguments):
+    """
+    Send a job to the daemon, prints its output and returns its result.
+    Raises RuntimeError if the job failed.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path or default_socket_path())
+        connection.sendall((json.dumps(dict(job=job, **arguments)) + '\n').encode())
+        with connection.makefile('rb') as f:
+            response = json.loads(f.readline())
+    print(response.get('output', ''), end='')
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+def popOption(argv, name, default=None):
+    # as asrs.popOption, which would import numpy, scipy and nibabel
+    if name not in argv:
+        return default
+    idx = argv.index(name)
+    value = argv[idx+1]
+    del argv[idx:idx+2]
+    return value
+
+def selectSeries(socket_path, dicomExportPath, ref1=None, bundle=None):
+    # the text menu of dicom_series_selector, with the series list of the daemon
+    while True:
+        series = request('series', socket_path, dicomExportPath=dicomExportPath, ref1=ref1, bundle=bundle)
+        print("Available DICOM Series:")
+        for i, s in enumerate(series):
+            if i == 0 or s['protocol'] != series[i-1]['protocol']:
+                print(f"\nProtocol: {s['protocol']}" if s['protocol'] is not None else "\nNo Protocol Name:")
+            print(f"  Series {s['seriesNumber']}: {s['description']} [{s['files']}]" +
+                  ("  <- predicted" if s['predicted'] else ""))
+        selection = input("\nSelect a series by series number (or 'r' to refresh, 'q' to quit): ").strip()
+        if selection.lower() == 'r':
+            continue
+        if selection.lower() == 'q':
+            return None
+        if selection not in [str(s['seriesNumber']) for s in series]:
+            print(f"Error: Series number {selection} not found")
+            return None
+        return selection
+
+def main(argv):
+    socket_path = popOption(argv, '--socket')
+    bundle = popOption(argv, '--bundle')
+    backend = popOption(argv, '--backend', 'flirt')
+    cropMargin = popOption(argv, '--crop-margin')
+    inMemory = '--in-memory' in argv
+    multiStart = '--multi-start' in argv
+    argv = [arg for arg in argv if arg not in ('--in-memory', '--multi-start')]
+    job, args = (argv[1], argv[2:]) if len(argv) > 1 else (None, [])
+    # the session 1 files of mp2rage, not needed with a bundle
+    nses1 = 0 if bundle is not None else 3
+    if job in ['asrs', 'gui'] and len(args) in ([2, 4] if job == 'asrs' else [1, 3]):
+        ref1, slab1 = args[-2:] if len(args) in [3, 4] else ('ref1.nii', 'slab1.nii')
+        if bundle is not None:
+            ref1 = slab1 = None
+        ref1, slab1, bundle = [f and os.path.abspath(f) for f in (ref1, slab1, bundle)]
+        dicomExportPath = os.path.abspath(args[0])
+        seriesNumber = args[1] if job == 'asrs' else selectSeries(socket_path, dicomExportPath, ref1, bundle)
+        if seriesNumber is None:
+            return 0
+        request('asrs', socket_path, dicomExportPath=dicomExportPath, seriesNumber=seriesNumber,
+                slab1=slab1, ref1=ref1, bundle=bundle, backend=backend, inMemory=inMemory,
+                cropMargin=float(cropMargin) if cropMargin is not None else None, multiStart=multiStart)
+    elif job == 'mp2rage' and len(args) - nses1 in [3, 4]:
+        # as asrs_mp2rage.py: INV2 and UNI may come from the same export folder
+        if len(args) == 3 + nses1:
+            args = [args[0], args[1], args[0]] + args[2:]
+        ses1 = [os.path.abspath(f) for f in args[4:]] if bundle is None else [None, None, None]
+        request('mp2rage', socket_path, dicomExportPathINV2=os.path.abspath(args[0]), seriesNumberINV2=args[1],
+                dicomExportPathUNI=os.path.abspath(args[2]), seriesNumberUNI=args[3],
+                inv2_ses1=ses1[0], uni_ses1=ses1[1], slab1=ses1[2],
+                bundle=bundle and os.path.abspath(bundle), backend=backend, multiStart=multiStart)
+    elif job == 'protocol' and len(args) == 1:
+        request('protocol', socket_path, nifti=os.path.abspath(args[0]))
+    elif job == 'convert' and len(args) == 3:
+        out = request('convert', socket_path, dicomExportPath=os.path.abspath(args[0]),
+                      seriesNumber=args[1], out=os.path.abspath(args[2]))
+        print(f"Written {out}")
+    elif job == 'series' and len(args) == 1:
+        for series in request('series', socket_path, dicomExportPath=os.path.abspath(args[0])):
+            print(f"Series {series['seriesNumber']}: {series['description']} ({series['protocol']}, " +
+                  f"{series['sequence']}) [{series['files']}] CRC {series['crc']}")
+    elif job == 'ping' and not args:
+        result = request('ping', socket_path)
+        print(f"ASRS daemon {result['pid']} up for {result['uptime']:.0f} s")
+    elif job == 'shutdown' and not args:
+        request('shutdown', socket_path)
+    else:
+        print(__doc__.split('Usage:')[1].strip('\n'))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv))
+    except (ConnectionRefusedError, FileNotFoundError):
+        print("Error: the ASRS daemon is not running (start it with asrs_daemon.py)")
+        sys.exit(1)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
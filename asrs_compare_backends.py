@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import asrs
+import sys
+import time
+import numpy as np
+""" Runs the registration of asrs.asrs with the FLIRT (reference) and the native backend
+and checks that both result in the same Siemens protocol parameters.
+
+Usage: asrs_compare_backends.py slab1.nii ref1.nii ref2.nii [--tol-mm 0.5] [--tol-deg 0.5]
+"""
+
+def compareProtocols(results_a, results_b, tol_mm, tol_deg):
+    # returns a list of differences (one line each) between two qform2SiemensProtocol results
+    differences = []
+    orientations_a = {(r[1], r[3]): r for r in results_a}
+    orientations_b = {(r[1], r[3]): r for r in results_b}
+    if orientations_a.keys() != orientations_b.keys():
+        differences.append(f"orientation types differ: {sorted(orientations_a)} vs {sorted(orientations_b)}")
+    for key in orientations_a.keys() & orientations_b.keys():
+        (pos_a, _, r1_a, _, r2_a, r3_a), (pos_b, _, r1_b, _, r2_b, r3_b) = orientations_a[key], orientations_b[key]
+        dpos = np.abs(np.subtract(pos_a, pos_b)).max()
+        # PE angles are compared modulo 360
+        dpe = abs((r3_a[0] - r3_b[0] + 180) % 360 - 180)
+        dangle = max(abs(r1_a - r1_b), abs(r2_a - r2_b), dpe)
+        if dpos > tol_mm or dangle > tol_deg:
+            differences.append(f"{key[0]} {key[1]}: position differs by {dpos:.1f} mm, " +
+                               f"angles by {dangle:.1f} deg")
+    return differences
+
+if __name__ == "__main__":
+    tol_mm = float(asrs.popOption(sys.argv, '--tol-mm', 0.5))
+    tol_deg = float(asrs.popOption(sys.argv, '--tol-deg', 0.5))
+    if len(sys.argv) != 4:
+        print("Usage: asrs_compare_backends.py slab1.nii ref1.nii ref2.nii [--tol-mm 0.5] [--tol-deg 0.5]")
+        sys.exit(1)
+    slab1, ref1, ref2 = sys.argv[1:4]
+    results = {}
+    for backend in ['flirt', 'native']:
+        print(f"{backend}:")
+        start = time.time()
+        results[backend] = asrs.asrs(slab1, ref1, ref2, backend)
+        print(f"({time.time() - start:.1f} s)")
+    differences = compareProtocols(results['flirt'], results['native'], tol_mm, tol_deg)
+    for difference in differences:
+        print(difference)
+    if differences:
+        sys.exit(1)
+    print(f"Backends agree (within {tol_mm} mm and {tol_deg} deg)")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+""" Resident ASRS service.
+
+Keeps the imported modules (nibabel, scipy, pydicom, nipype), the DICOM header indexes of
+the export folders and loaded session 1 bundles in memory and accepts jobs over a Unix
+socket, so that a request from the scanner console (asrs_client.py) only costs the actual
+computation.
+
+Every request is one line of JSON ({"job": name, ...arguments}), answered by one line of
+JSON ({"ok": true, "result": ..., "output": printed text} or {"ok": false, "error": ...}).
+Jobs are processed one at a time. Jobs:
+
+    ping                                             -> daemon pid and uptime
+    series     dicomExportPath [ref1 bundle]         -> series of the export folder (the one
+                                                        asrs_gui would predict is marked)
+    convert    dicomExportPath seriesNumber out      -> writes the series as NIfTI to out
+    protocol   nifti | qform dims                    -> Siemens protocol parameters
+    asrs       dicomExportPath seriesNumber slab1 ref1 [bundle backend inMemory cropMargin multiStart]
+    mp2rage    dicomExportPathINV2 seriesNumberINV2 dicomExportPathUNI seriesNumberUNI
+               inv2_ses1 uni_ses1 slab1 [bundle backend multiStart]
+    shutdown
+
+Usage: asrs_daemon.py [--socket path]   (default: $ASRS_SOCKET or asrs.sock in the ASRS cache)
+"""
+import os
+import io
+import sys
+import json
+import time
+import tempfile
+import threading
+import contextlib
+import socket
+import socketserver
+from dicom_series_selector import (DicomHeaderIndex, group_acquisitions, calculate_series_crc,
+                                   find_series, predict_series, reference_series_info, cache_dir)
+
+def default_socket_path():
+    return os.environ.get('ASRS_SOCKET', os.path.join(cache_dir(), 'asrs.sock'))
+
+class AsrsService:
+    """
+    The warm state of the daemon and the implementation of its jobs.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.indexes = {}
+        self.bundles = {}
+        self._warm_up()
+
+    def _warm_up(self):
+        # everything a job may need is imported once at start-up
+        import asrs
+        import asrs_native
+        import asrs_bundle
+        import asrs_mp2rage
+        import pydicom
+        from nibabel.nicom import dicomwrappers
+        from nipype.interfaces import fsl, dcm2nii
+
+    def index(self, dicomExportPath):
+        # header index of an export folder, refreshed (new files only) on every use
+        path = os.path.abspath(dicomExportPath)
+        if path not in self.indexes:
+            self.indexes[path] = DicomHeaderIndex(path)
+        self.indexes[path].refresh()
+        return self.indexes[path]
+
+    def bundle(self, fname):
+        # loaded session 1 bundles, reloaded when the file changes
+        key = (os.path.abspath(fname), os.path.getmtime(fname))
+        if key not in self.bundles:
+            import asrs_bundle
+            self.bundles = {k: v for k, v in self.bundles.items() if k[0] != key[0]}
+            self.bundles[key] = asrs_bundle.loadBundle(fname)
+        return self.bundles[key]
+
+    def load_series(self, dicomExportPath, seriesNumber):
+        import asrs
+        files = find_series(self.index(dicomExportPath).series_dict(), seriesNumber)
+        if files is None:
+            raise ValueError(f"Series {seriesNumber} not found in {dicomExportPath}")
+        return asrs.loadSelectedSeries(dicomExportPath, calculate_series_crc(files[0][1]), files)
+
+    def job_ping(self):
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started}
+
+    @contextlib.contextmanager
+    def scratch(self):
+        # the FLIRT chain and BET write into the working directory
+        import asrs
+        with tempfile.TemporaryDirectory(prefix='asrs_daemon_', dir=asrs.scratchParent()) as scratch:
+            cwd = os.getcwd()
+            os.chdir(scratch)
+            try:
+                yield scratch
+            finally:
+                os.chdir(cwd)
+
+    def job_series(self, dicomExportPath, ref1=None, bundle=None):
+        acquisitions = group_acquisitions(self.index(dicomExportPath).series_dict())
+        predicted = None
+        if bundle is not None:
+            metadata = self.bundle(bundle).metadata
+            predicted = predict_series(acquisitions, metadata['protocol'], metadata['sequence'])
+        elif ref1 is not None:
+            predicted = predict_series(acquisitions, *reference_series_info(ref1))
+        series = []
+        for protocol_name, series_list in acquisitions:
+            for series_uid, files in series_list:
+                first_ds = files[0][1]
+                series.append({'seriesNumber': getattr(first_ds, 'SeriesNumber', None),
+                               'protocol': protocol_name,
+                               'sequence': getattr(first_ds, 'SequenceName', None),
+                               'description': getattr(first_ds, 'SeriesDescription', None),
+                               'files': len(files), 'crc': calculate_series_crc(first_ds),
+                               'predicted': predicted is not None and predicted[0] == series_uid})
+        return series
+
+    def job_convert(self, dicomExportPath, seriesNumber, out):
+        import nibabel as nb
+        img = self.load_series(dicomExportPath, seriesNumber)
+        if isinstance(img, list):
+            img = img[0]
+        if isinstance(img, str):
+            # converted by dcm2niix
+            img = nb.load(img)
+        nb.save(img, out)
+        return out
+
+    def job_protocol(self, nifti=None, qform=None, dims=None):
+        import numpy as np
+        import asrs
+        if nifti is not None:
+            img = asrs.loadImage(nifti)
+            qform, dims = img.affine, img.shape[:3]
+        return asrs.qform2SiemensProtocol(np.array(qform), tuple(dims))
+
+    def job_asrs(self, dicomExportPath, seriesNumber, slab1=None, ref1=None, bundle=None,
+                 backend='flirt', inMemory=False, cropMargin=None, multiStart=False):
+        import asrs
+        ref2 = self.load_series(dicomExportPath, seriesNumber)
+        if bundle is not None:
+            bundle = self.bundle(bundle)
+        with self.scratch():
+            return asrs.asrs(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin, multiStart)
+
+    def job_mp2rage(self, dicomExportPathINV2, seriesNumberINV2, dicomExportPathUNI, seriesNumberUNI,
+                    inv2_ses1=None, uni_ses1=None, slab1=None, bundle=None, backend='flirt', multiStart=False):
+        import asrs_mp2rage
+        if bundle is not None:
+            bundle = self.bundle(bundle)
+        with self.scratch():
+            return asrs_mp2rage.mp2rage_asrs(dicomExportPathINV2, seriesNumberINV2, dicomExportPathUNI,
+                                             seriesNumberUNI, inv2_ses1, uni_ses1, slab1, bundle, backend,
+                                             multiStart)
+
+    def run(self, request):
+        request = dict(request)
+        job = getattr(self, f"job_{request.pop('job', None)}", None)
+        if job is None:
+            raise ValueError(f"Unknown job in {request}")
+        return job(**request)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        output = io.StringIO()
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get('job') == 'shutdown':
+                response = {'ok': True, 'result': None}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                with contextlib.redirect_stdout(output):
+                    result = self.server.service.run(request)
+                response = {'ok': True, 'result': result}
+        except Exception as e:
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        response['output'] = output.getvalue()
+        self.wfile.write((json.dumps(response, default=_to_json) + '\n').encode())
+
+def _to_json(value):
+    # numpy values in job results
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise RuntimeError(f"An ASRS daemon is already listening on {socket_path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            # left over from a daemon that did not shut down cleanly
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    service = AsrsService()
+    # the socket is only accessible to the user running the daemon
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.service = service
+    print(f"ASRS daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+if __name__ == "__main__":
+    import asrs
+    socket_path = asrs.popOption(sys.argv, '--socket', default_socket_path())
+    if len(sys.argv) != 1:
+        print("Usage: asrs_daemon.py [--socket path]")
+        sys.exit(1)
+    serve(socket_path)
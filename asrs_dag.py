@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" Minimal dependency graph execution for the ASRS pipelines.
+
+A graph is a dict mapping node names to (function, [names of dependencies]); every function
+is called with the results of its dependencies (in the given order) as arguments. Nodes
+whose dependencies are done run concurrently in a thread pool, which is sufficient as the
+expensive steps are external tools (dcm2niix, FSL) or numpy code releasing the GIL.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def runGraph(graph, maxWorkers=None):
+    """
+    Run all nodes of graph, returns (results, timings) with results mapping node names
+    to return values and timings mapping node names to (start, end) in seconds since
+    the start of the graph. An exception in a node stops the graph and is re-raised.
+    """
+    for name, (_, dependencies) in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise ValueError(f"Node {name} depends on unknown node {dependency}")
+    results, timings, running = {}, {}, {}
+    pending = dict(graph)
+    t0 = time.monotonic()
+
+    def timed(name, function, *args):
+        start = time.monotonic() - t0
+        result = function(*args)
+        timings[name] = (start, time.monotonic() - t0)
+        return result
+
+    # by default every node gets a thread, the external tools share the cores
+    with ThreadPoolExecutor(max_workers=maxWorkers or max(1, len(graph))) as executor:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    args = [results[dependency] for dependency in dependencies]
+                    running[executor.submit(timed, name, function, *args)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Cyclic dependencies between {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    for other in running:
+                        other.cancel()
+                    raise future.exception()
+                results[name] = future.result()
+    return results, timings
+
+def printTimings(timings):
+    # per node timing report, in order of start time
+    print("Timing (start - end, duration):")
+    for name, (start, end) in sorted(timings.items(), key=lambda item: item[1]):
+        print(f"  {name:<20} {start:7.1f} - {end:7.1f} s  ({end - start:.1f} s)")
+    if timings:
+        total = max(end for _, end in timings.values())
+        serial = sum(end - start for start, end in timings.values())
+        print(f"  total {total:.1f} s (serial execution: {serial:.1f} s)")
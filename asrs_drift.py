@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+""" Real-time slab drift monitor.
+
+While the slab of session 2 (positioned with ASRS) is running, every volume that arrives in the
+realtime DICOM export is converted in-process and registered to the first volume of the session 1
+slab (slab1.nii) with a fast least squares rigid registration (asrs_native.track), starting from
+the result of the previous volume. The position and angles the slab would need to cover the
+session 1 anatomy again (flirtToSform, qform2SiemensProtocolBatch) are compared to the ones it is
+running with, and the offsets are printed for every volume together with the latency since the
+files of the volume arrived. When processing falls behind the acquisition, only the newest
+complete volume is processed.
+
+The running series is found by the ProtocolName/SequenceName of slab1.nii (read from slab1.json,
+written by dcm2niix) or the ones given on the command line; series that are already complete when
+the monitor is started are ignored unless --include-existing is given. Once the series is found,
+only its directory (or the files reported by inotify) is looked at for new files.
+
+Usage: asrs_drift.py dicomExportPath [--slab1 slab1.nii] [--protocol NAME] [--sequence NAME]
+                     [--tr SECONDS] [--threshold-mm 1.0] [--threshold-deg 1.0] [--include-existing]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.spatial.transform import Rotation
+import asrs
+import asrs_native
+from dicom_series_selector import (DicomHeaderIndex, ExportFollower, reference_series_info,
+                                   series_matches)
+
+def _volumeHeader(path):
+    # (SeriesInstanceUID, InstanceNumber, RepetitionTime in s or None, whether the file holds a
+    # whole volume), None if the file is not DICOM
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True,
+                             specific_tags=['SeriesInstanceUID', 'InstanceNumber', 'RepetitionTime',
+                                            'ImageType', 'NumberOfFrames'])
+    except (InvalidDicomError, OSError):
+        return None
+    tr = float(ds.RepetitionTime) / 1000 if 'RepetitionTime' in ds else None
+    wholeVolume = 'MOSAIC' in getattr(ds, 'ImageType', []) or int(getattr(ds, 'NumberOfFrames', 1) or 1) > 1
+    return str(getattr(ds, 'SeriesInstanceUID', '')), int(getattr(ds, 'InstanceNumber', 0) or 0), tr, wholeVolume
+
+class SlabDriftMonitor:
+    """
+    Follows the running slab series in a realtime DICOM export and registers every new volume
+    to the first volume of the session 1 slab. The first volume starts from the identity (the
+    slab was positioned to cover the session 1 anatomy), the following ones from the previous
+    result. Series whose last file is older than quietPeriod seconds at the start are ignored
+    unless includeExisting is set.
+    """
+    def __init__(self, dicomExportPath, slab1, protocolName, sequenceName=None, includeExisting=False,
+                 schedule=asrs_native.TRACK_SCHEDULE, pollInterval=0.2, quietPeriod=3.0):
+        self.protocolName = protocolName
+        self.sequenceName = sequenceName
+        self.schedule = schedule
+        self.index = DicomHeaderIndex(dicomExportPath)
+        self.follower = ExportFollower(self.index.dicom_dir, pollInterval)
+        self.img_slab1 = asrs_native.firstVolume(asrs.loadImage(slab1))
+        self.slab1Pyramid = asrs_native.pyramid(self.img_slab1, schedule)
+        self.ignored = set()
+        if not includeExisting:
+            # complete series, a slab series that is still arriving is followed
+            self.index.refresh()
+            now_ns = time.time_ns()
+            for uid, files in self.index.series_dict().items():
+                if now_ns - max(self.index.entries[path][1] for path, _ in files) >= quietPeriod * 1e9:
+                    self.ignored.add(uid)
+        self.seriesUid = None
+        # directories of the running series, the only ones scanned once it is found
+        self.directories = set()
+        # files of these directories that were read or belong to other series
+        self.seen = set()
+        # path -> size of files that may still be written (polling only)
+        self.pending = {}
+        self.tr = None
+        self.filesPerVolume = None
+        # path -> (instance number, arrival time) of the files of the running series seen so far
+        self.instances = {}
+        self.processed = set()
+        self.xform = None
+        self.geometry = None
+
+    def _findSeries(self):
+        # newest matching series that was not there at the start
+        candidates = [(getattr(files[0][1], 'SeriesNumber', 0) or 0, uid)
+                      for uid, files in self.index.series_dict().items()
+                      if uid not in self.ignored and series_matches(files[0][1], self.protocolName,
+                                                                    self.sequenceName)]
+        return max(candidates)[1] if candidates else None
+
+    def _newFiles(self, written):
+        # completely written files of the series directories not seen before: the ones
+        # reported by inotify (written), or, when polling, the ones with the same size as in
+        # the previous scan
+        if written is not None:
+            ready = {path for path in written
+                     if path not in self.seen and os.path.dirname(path) in self.directories}
+            candidates = list(self.pending)
+        else:
+            ready = set()
+            candidates = [entry.path for directory in self.directories for entry in os.scandir(directory)
+                          if entry.path not in self.seen and entry.is_file()]
+        for path in candidates:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                self.pending.pop(path, None)
+                continue
+            if self.pending.get(path) == size:
+                ready.add(path)
+            else:
+                self.pending[path] = size
+        for path in ready:
+            self.pending.pop(path, None)
+        self.seen.update(ready)
+        return sorted(ready)
+
+    def completeVolumes(self, written=None):
+        """
+        Look for new files of the running series, returns the complete and not yet processed
+        volumes as a list of (volume number, file paths), oldest first. written are the paths
+        reported by ExportFollower.wait (None: scan the series directories).
+        """
+        if self.seriesUid is None:
+            if written is not None and not written:
+                return []
+            # until the series is found the whole export is scanned, without storing the index
+            self.index.refresh(save=False)
+            self.seriesUid = self._findSeries()
+            if self.seriesUid is None:
+                return []
+            files = [path for path, _ in self.index.series_dict()[self.seriesUid]]
+            self.directories = {os.path.dirname(path) for path in files}
+            self.seen.update(self.index.entries)
+            self.seen.difference_update(files)
+            # the newest files may still be written, they are taken once their size is stable
+            self.pending.update((path, self.index.entries[path][0]) for path in files)
+            return []
+        for path in self._newFiles(written):
+            header = _volumeHeader(path)
+            if header is None or header[0] != self.seriesUid:
+                continue
+            _, instance, tr, wholeVolume = header
+            try:
+                self.instances[path] = (instance, os.path.getmtime(path))
+            except OSError:
+                continue
+            if self.filesPerVolume is None:
+                # mosaic/multi-frame files hold a volume, otherwise one slice per file
+                self.filesPerVolume = 1 if wholeVolume else self.img_slab1.shape[2]
+                self.tr = tr
+        volumes = {}
+        for path, (instance, _) in self.instances.items():
+            volumes.setdefault((instance - 1) // self.filesPerVolume, []).append(path)
+        return sorted((volume, paths) for volume, paths in volumes.items()
+                      if volume not in self.processed and len(paths) == self.filesPerVolume)
+
+    def process(self, volume, paths):
+        """
+        Register one volume, returns a dict with the FLIRT matrix slab1 -> volume, the protocol
+        rows (qform2SiemensProtocolBatch) of the running and the corrected slab position, the
+        offsets, the relative residual of the registration, the processing time and the latency
+        since the last file of the volume arrived in seconds. Returns None if there is no
+        protocol position for the running or the corrected slab geometry.
+        """
+        start = time.perf_counter()
+        img = asrs.loadFromDicomSeries(paths)
+        init = np.eye(4) if self.xform is None else self.xform
+        self.xform, residual = asrs_native.track(self.img_slab1, img, init, self.schedule, self.slab1Pyramid)
+        self.processed.add(volume)
+        # where the slab has to be to cover the session 1 anatomy, compared to where it is
+        target = np.asarray(asrs.flirtToSform(self.xform, self.img_slab1, img))
+        dims = img.shape[:3]
+        if self.geometry is None or not np.allclose(self.geometry[0], img.affine):
+            self.geometry = (img.affine, asrs.qform2SiemensProtocolBatch(img.affine, dims))
+        current = self.geometry[1]
+        corrected = asrs.qform2SiemensProtocolBatch(target, dims)
+        if not len(current) or not len(corrected):
+            print(f"vol {volume + 1:4d}: no protocol position for the slab geometry, skipped", flush=True)
+            return None
+        # rows of the same orientation type as the first one of the running position
+        row = current[0]
+        match = [r for r in corrected if r['orientation'] == row['orientation']]
+        D = target @ np.linalg.inv(img.affine)
+        center = img.affine @ np.r_[(np.array(dims) - 1) / 2, 1]
+        return {'volume': volume, 'xform': self.xform, 'current': row,
+                'corrected': match[0] if match else corrected[0],
+                'position': (match[0]['position'] - row['position']) if match else None,
+                'angles': (match[0]['angle1'] - row['angle1'], match[0]['angle2'] - row['angle2'])
+                          if match else None,
+                'shift_mm': float(np.linalg.norm((D @ center - center)[:3])),
+                'rotation_deg': float(np.degrees(Rotation.from_matrix(D[:3, :3]).magnitude())),
+                'residual': residual,
+                'processing': time.perf_counter() - start,
+                'latency': time.time() - max(self.instances[path][1] for path in paths)}
+
+    def run(self, tr=None, thresholdMm=1.0, thresholdDeg=1.0, timeout=None):
+        """
+        Process volumes until interrupted (or timeout seconds without a new volume),
+        prints one line per volume and returns the list of process results.
+        """
+        results = []
+        lastVolume = time.monotonic()
+        written = None
+        while True:
+            volumes = self.completeVolumes(written)
+            if not volumes:
+                if timeout is not None and time.monotonic() - lastVolume >= timeout:
+                    return results
+                written = self.follower.wait(self.follower.poll_interval)
+                continue
+            written = None
+            lastVolume = time.monotonic()
+            # behind the acquisition: skip to the newest volume
+            for volume, _ in volumes[:-1]:
+                self.processed.add(volume)
+            result = self.process(*volumes[-1])
+            if result is None:
+                continue
+            results.append(result)
+            printDrift(result, len(volumes) - 1, tr or self.tr, thresholdMm, thresholdDeg)
+
+def printDrift(result, skipped, tr, thresholdMm, thresholdDeg):
+    row = result['current']
+    line = f"vol {result['volume'] + 1:4d}: "
+    if result['position'] is not None:
+        dX, dY, dZ = result['position']
+        a1, a2 = result['angles']
+        line += (f"dL {dX:+6.2f} dP {dY:+6.2f} dH {dZ:+6.2f} mm, {row['rot1']} {a1:+5.2f} " +
+                 f"{row['rot2']} {a2:+5.2f} deg, ")
+    line += (f"|{result['shift_mm']:.2f} mm, {result['rotation_deg']:.2f} deg| " +
+             f"latency {result['latency']:.2f} s, processing {result['processing']:.2f} s")
+    if tr is not None:
+        line += f" / TR {tr:.2f} s" + (" (slower than TR)" if result['processing'] > tr else "")
+    if skipped:
+        line += f", {skipped} volume(s) skipped"
+    print(line, flush=True)
+    if result['shift_mm'] > thresholdMm or result['rotation_deg'] > thresholdDeg:
+        print(f"  drift above {thresholdMm} mm / {thresholdDeg} deg, session 1 position: " +
+              asrs.formatSiemensProtocol(result['corrected']), flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monitor the drift of the running slab from the session 1 position")
+    parser.add_argument('dicomExportPath')
+    parser.add_argument('--slab1', default='slab1.nii', help="session 1 slab (default: slab1.nii)")
+    parser.add_argument('--protocol', help="ProtocolName of the slab (default: from slab1.json)")
+    parser.add_argument('--sequence', help="SequenceName of the slab (default: from slab1.json)")
+    parser.add_argument('--tr', type=float, help="repetition time in seconds (default: from the DICOM headers)")
+    parser.add_argument('--threshold-mm', type=float, default=1.0,
+                        help="print the session 1 position when the slab moved more than this (mm)")
+    parser.add_argument('--threshold-deg', type=float, default=1.0,
+                        help="print the session 1 position when the slab rotated more than this (degrees)")
+    parser.add_argument('--include-existing', action='store_true',
+                        help="also consider series that are already complete in the export folder")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dicomExportPath):
+        print("Error: dicomExportPath does not exist or is not a folder")
+        sys.exit(1)
+    if not os.path.exists(args.slab1):
+        print(f"Error: {args.slab1} not found")
+        sys.exit(1)
+    protocol_name, sequence_name = reference_series_info(args.slab1)
+    protocol_name = args.protocol or protocol_name
+    sequence_name = args.sequence or sequence_name
+    if protocol_name is None:
+        print("Error: ProtocolName of the slab unknown (no slab1.json), please use --protocol")
+        sys.exit(1)
+    monitor = SlabDriftMonitor(args.dicomExportPath, args.slab1, protocol_name, sequence_name,
+                               args.include_existing)
+    print(f"Waiting for {protocol_name} ({sequence_name}) volumes in {args.dicomExportPath}...")
+    try:
+        monitor.run(args.tr, args.threshold_mm, args.threshold_deg)
+    except KeyboardInterrupt:
+        pass
@@ -2,19 +2,29 @@
 import asrs
 import sys
 import os
-from dicom_series_selector import dicom_series_selector
+from dicom_series_selector import dicom_series_selector, reference_series_info
+from asrs_speculate import SpeculativeRegistration
 """ This script handles one specific use case of ASRS, it assume that:
 - there are two locally available nifti files from sessions 1: ref1.nii and slab1.nii
 - there is a dicom realtime export folder in which at some point the dicoms belonging to
   the reference images of session 2 will be available
 - once they are available, the user can select the series interactively and asrs will compute
   the new slab positioning accordingly
+- while the menu is open, the most likely series is already converted and registered in the
+  background (disable with --no-speculate)
 
 Usage: asrs_mp2rage.py dicomExportPath 
 """
 if __name__ == "__main__":
     # we check if all requirements are met
     # 1. check if asrs_gui was started with exactly one argument that is an existing folder
+    backend = asrs.popOption(sys.argv, '--backend', 'flirt')
+    inMemory = asrs.popFlag(sys.argv, '--in-memory')
+    bundleFile = asrs.popOption(sys.argv, '--bundle')
+    cropMargin = asrs.popOption(sys.argv, '--crop-margin')
+    cropMargin = float(cropMargin) if cropMargin is not None else None
+    speculate = not asrs.popFlag(sys.argv, '--no-speculate')
+    multiStart = asrs.popFlag(sys.argv, '--multi-start')
     if len(sys.argv)!=2:
         print("Usage: asrs_mp2rage.py dicomExportPath")
         sys.exit(1)
@@ -22,28 +32,53 @@ if __name__ == "__main__":
     if not os.path.exists(dicomExportPath) or not os.path.isdir(dicomExportPath):
         print("Error: dicomExportPath does not exist or is not a folder")
         sys.exit(1)
-    # 2. Check if slab1.nii exist (and there is no additional slab1.nii.gz)
-    if not os.path.exists("slab1.nii"):
-        print("Error: slab1.nii not found in current folder")
-        sys.exit(1)
-    if os.path.exists("slab1.nii.gz"):
-        print("Error: slab1.nii.gz (in addition to slab1.nii) found in current folder, please delete")
-        sys.exit(1)
+    # with a session 1 bundle (asrs_bundle.py prepare), slab1.nii and ref1.nii are not needed
+    slab1 = ref1 = bundle = None
+    if bundleFile is not None:
+        import asrs_bundle
+        bundle = asrs_bundle.loadBundle(bundleFile)
+        protocolName, sequenceName = bundle.metadata['protocol'], bundle.metadata['sequence']
+    else:
+        # 2. Check if slab1.nii exist (and there is no additional slab1.nii.gz)
+        if not os.path.exists("slab1.nii"):
+            print("Error: slab1.nii not found in current folder")
+            sys.exit(1)
+        if os.path.exists("slab1.nii.gz"):
+            print("Error: slab1.nii.gz (in addition to slab1.nii) found in current folder, please delete")
+            sys.exit(1)
 
-    slab1 = 'slab1.nii'
+        slab1 = 'slab1.nii'
 
-    # 3. Check if ref1.nii exist (and there is no additional ref1.nii.gz)
-    if not os.path.exists("ref1.nii"):
-        print("Error: ref1.nii not found in current folder")
-        sys.exit(1)
-    if os.path.exists("ref1.nii.gz"):
-        print("Error: ref1.nii.gz (in addition to ref1.nii) found in current folder, please delete")
-        sys.exit(1)
+        # 3. Check if ref1.nii exist (and there is no additional ref1.nii.gz)
+        if not os.path.exists("ref1.nii"):
+            print("Error: ref1.nii not found in current folder")
+            sys.exit(1)
+        if os.path.exists("ref1.nii.gz"):
+            print("Error: ref1.nii.gz (in addition to ref1.nii) found in current folder, please delete")
+            sys.exit(1)
 
-    ref1 = 'ref1.nii'
+        ref1 = 'ref1.nii'
+        protocolName, sequenceName = reference_series_info(ref1)
 
     # if all requirements are met, we can start the selection GUI 
-    crc_series_number = dicom_series_selector(dicomExportPath, menu_type="interactive")
-    ref2 = asrs.loadFromDicomExport(dicomExportPath, crc_series_number)
-    print("Running ASRS...")
-    asrs.asrs(slab1, ref1, ref2)
+    speculator = None
+    if speculate:
+        speculator = SpeculativeRegistration(dicomExportPath, slab1, ref1, backend, inMemory, bundle,
+                                             cropMargin, protocolName, sequenceName, multiStart=multiStart)
+        speculator.follow()
+    crc_series_number, series_files = dicom_series_selector(dicomExportPath, menu_type="interactive",
+                                                            return_files=True, speculator=speculator)
+    result = None
+    if speculator is not None:
+        # the speculative result if the selected series was predicted, cancelled otherwise
+        result = speculator.take(series_files or [])
+    if series_files is None:
+        sys.exit(0)
+    if result is not None:
+        print("Using the background registration of the predicted series")
+    else:
+        ref2 = asrs.loadSelectedSeries(dicomExportPath, crc_series_number, series_files)
+        print("Running ASRS...")
+        result = asrs.asrsMatrices(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin, multiStart)
+    _, sform, dims = result
+    asrs.qform2SiemensProtocol(sform, dims)
@@ -1,45 +1,73 @@
 import asrs
+from asrs_dag import runGraph, printTimings
 from nipype.interfaces.fsl import BET, ImageMaths, FSLCommand
 import sys
 
-def generate_mp2rage_refs(inv2_ses1, uni_ses1,inv2_ses2, uni_ses2):
+def bet_inv2(inv2):
     FSLCommand.set_default_output_type('NIFTI')
-
     # bet on inv:
-    bet1_result = BET(in_file=inv2_ses1).run()
-    bet2_result = BET(in_file=inv2_ses2).run()
+    return BET(in_file=inv2).run().outputs.out_file
 
+def mask_uni(uni, brain):
+    FSLCommand.set_default_output_type('NIFTI')
     # mask uni:
-    maskuni1_result = ImageMaths(in_file=uni_ses1,mask_file=bet1_result.outputs.out_file).run()
-    maskuni2_result = ImageMaths(in_file=uni_ses2,mask_file=bet2_result.outputs.out_file).run()
+    return ImageMaths(in_file=uni,mask_file=brain).run().outputs.out_file
+
+def generate_mp2rage_ref(inv2, uni):
+    return mask_uni(uni, bet_inv2(inv2))
 
-    ref1=maskuni1_result.outputs.out_file
-    ref2=maskuni2_result.outputs.out_file
-    return ref1, ref2
+def mp2rage_ref_nodes(session, inv2, uni):
+    # graph nodes (see asrs_dag) computing the masked UNI of one session from the nodes inv2 and uni
+    return {f"bet_{session}": (bet_inv2, [inv2]),
+            f"ref_{session}": (mask_uni, [uni, f"bet_{session}"])}
+
+def mp2rage_asrs(dicomExportPathINV2, seriesNumberINV2, dicomExportPathUNI, seriesNumberUNI,
+                 inv2_ses1=None, uni_ses1=None, slab1=None, bundle=None, backend='flirt', multiStart=False):
+    # conversions, brain extraction and masking of both sessions run concurrently, followed by
+    # asrs; bundle (instead of the session 1 files) is a file or a loaded asrs_bundle bundle
+    graph = {'inv2_ses2': (lambda: asrs.loadFromDicomExport(dicomExportPathINV2, seriesNumberINV2), []),
+             'uni_ses2': (lambda: asrs.loadFromDicomExport(dicomExportPathUNI, seriesNumberUNI), [])}
+    graph.update(mp2rage_ref_nodes('ses2', 'inv2_ses2', 'uni_ses2'))
+    if bundle is None:
+        graph['inv2_ses1'] = (lambda: inv2_ses1, [])
+        graph['uni_ses1'] = (lambda: uni_ses1, [])
+        graph.update(mp2rage_ref_nodes('ses1', 'inv2_ses1', 'uni_ses1'))
+        graph['asrs'] = (lambda ref1, ref2: asrs.asrs(slab1, ref1, ref2, backend, multiStart=multiStart), ['ref_ses1', 'ref_ses2'])
+    else:
+        import asrs_bundle
+        graph['bundle'] = (lambda: asrs_bundle.loadBundle(bundle) if isinstance(bundle, str) else bundle, [])
+        graph['asrs'] = (lambda bundle, ref2: asrs.asrs(None, None, ref2, backend, bundle=bundle,
+                                                                    multiStart=multiStart),
+                         ['bundle', 'ref_ses2'])
+    results, timings = runGraph(graph)
+    printTimings(timings)
+    return results['asrs']
 
 if __name__ == "__main__":
-    if len(sys.argv)==7:
-        dicomExportPath = sys.argv[1]
+    # with a bundle prepared by asrs_bundle.py (--inv2), the session 1 files are not needed
+    bundle = asrs.popOption(sys.argv, '--bundle')
+    backend = asrs.popOption(sys.argv, '--backend', 'flirt')
+    multiStart = asrs.popFlag(sys.argv, '--multi-start')
+    # without a bundle, inv2_ses1 uni_ses1 slab1 follow the session 2 arguments
+    nses1 = 0 if bundle is not None else 3
+    if len(sys.argv)==4+nses1:
+        dicomExportPathINV2 = dicomExportPathUNI = sys.argv[1]
         seriesNumberINV2 = sys.argv[2]
         seriesNumberUNI = sys.argv[3]
-        inv2_ses1 = sys.argv[4]    
-        uni_ses1 = sys.argv[5]
-        slab1 = sys.argv[6]
-        inv2_ses2 = asrs.loadFromDicomExport(dicomExportPath, seriesNumberINV2)
-        uni_ses2 = asrs.loadFromDicomExport(dicomExportPath, seriesNumberUNI)
-    elif len(sys.argv)==8:
+        ses1 = sys.argv[4:7]
+    elif len(sys.argv)==5+nses1:
         dicomExportPathINV2 = sys.argv[1]
         seriesNumberINV2 = sys.argv[2]
         dicomExportPathUNI = sys.argv[3]
         seriesNumberUNI = sys.argv[4]
-        inv2_ses1 = sys.argv[5]    
-        uni_ses1 = sys.argv[6]
-        slab1 = sys.argv[7]
-        inv2_ses2 = asrs.loadFromDicomExport(dicomExportPathINV2, seriesNumberINV2)
-        uni_ses2 = asrs.loadFromDicomExport(dicomExportPathUNI, seriesNumberUNI)
+        ses1 = sys.argv[5:8]
     else:
         print('Usage: asrs_mp2rage.py dicomExportPath seriesNumberINV2 seriesNumberUNI inv2_ses1 uni_ses1 slab1')
         print('or: asrs_mp2rage.py dicomExportPathINV2 seriesNumberINV2 dicomExportPathUNI seriesNumberUNI inv2_ses1 uni_ses1 slab1')
-        exit
-    ref1, ref2 = generate_mp2rage_refs(inv2_ses1, uni_ses1,inv2_ses2, uni_ses2)
-    asrs.asrs(slab1, ref1, ref2)
+        print('or: asrs_mp2rage.py --bundle bundle.npz dicomExportPath seriesNumberINV2 seriesNumberUNI')
+        print('or: asrs_mp2rage.py --bundle bundle.npz dicomExportPathINV2 seriesNumberINV2 dicomExportPathUNI seriesNumberUNI')
+        print('options: [--backend flirt|native] [--multi-start]')
+        sys.exit(1)
+    inv2_ses1, uni_ses1, slab1 = ses1 if bundle is None else (None, None, None)
+    mp2rage_asrs(dicomExportPathINV2, seriesNumberINV2, dicomExportPathUNI, seriesNumberUNI,
+                 inv2_ses1, uni_ses1, slab1, bundle, backend, multiStart)
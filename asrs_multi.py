@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import asrs
+import sys
+""" ASRS for several target boxes of one protocol (e.g. fMRI slab, field map, shim volume,
+partial-coverage anatomy), all positioned in session 1 relative to the same ref1.
+
+The whole-brain ref1 -> ref2 registration is computed once, the fine-tuning of the targets
+runs in parallel, and the Siemens protocol parameters of all targets are printed in one report.
+
+Usage: asrs_multi.py dicomPath seriesNumber ref1.nii target1.nii [target2.nii ...]
+       asrs_multi.py --ref2 ref2.nii ref1.nii target1.nii [target2.nii ...]
+       [--backend flirt|native] [--crop-margin MM] [--workers N] [--multi-start]
+"""
+
+if __name__ == "__main__":
+    backend = asrs.popOption(sys.argv, '--backend', 'flirt')
+    cropMargin = asrs.popOption(sys.argv, '--crop-margin')
+    cropMargin = float(cropMargin) if cropMargin is not None else None
+    workers = asrs.popOption(sys.argv, '--workers')
+    workers = int(workers) if workers is not None else None
+    multiStart = asrs.popFlag(sys.argv, '--multi-start')
+    ref2 = asrs.popOption(sys.argv, '--ref2')
+    nRef2 = 0 if ref2 is not None else 2
+    if len(sys.argv) < 3 + nRef2:
+        print("Usage: asrs_multi.py dicomPath seriesNumber ref1.nii target1.nii [target2.nii ...]")
+        print("or: asrs_multi.py --ref2 ref2.nii ref1.nii target1.nii [target2.nii ...]")
+        print("options: [--backend flirt|native] [--crop-margin MM] [--workers N] [--multi-start]")
+        sys.exit(1)
+    if ref2 is None:
+        ref2 = asrs.loadFromDicomExport(sys.argv[1], sys.argv[2])
+    ref1, targets = sys.argv[1 + nRef2], sys.argv[2 + nRef2:]
+    asrs.asrsMulti(targets, ref1, ref2, backend, cropMargin, workers, multiStart)
@@ -0,0 +1,133 @@
+""" Multi-start registration of ref1 to ref2.
+
+Instead of a single registration that may end in a wrong local minimum, several
+registrations with different starting points (centre of mass alignment with search, the
+qforms, the qforms rotated by a few degrees about each axis) and resolution schedules run
+concurrently. All results are scored with the same cost (correlation ratio of
+asrs_native at the finest resolution), so that FLIRT and native candidates are
+comparable, and the best one is used. The agreement of the other candidates with the
+best one is reported as a confidence measure.
+"""
+import numpy as np
+from scipy.spatial.transform import Rotation
+import asrs
+import asrs_native
+
+PERTURBATION_DEG = 10
+# candidates closer than this to the best one agree with it
+AGREEMENT_MM = 1.0
+AGREEMENT_DEG = 1.0
+COARSE_SCHEDULE = ((16, None),) + asrs_native.SCHEDULE
+
+def startingPoints(img_ref1, img_ref2):
+    # list of (name, initial FLIRT matrix or None for centre of mass and search, schedule)
+    qform = asrs_native.qformMatrix(img_ref1, img_ref2)
+    center = asrs_native.centerOfMass(img_ref1)
+    starts = [('centre of mass', None, asrs_native.SCHEDULE),
+              ('centre of mass, coarse', None, COARSE_SCHEDULE),
+              ('qform', qform, asrs_native.SCHEDULE),
+              ('qform, coarse', qform, COARSE_SCHEDULE)]
+    for axis in 'xyz':
+        for sign in (-1, 1):
+            # rotation about the centre of ref1 before the qform alignment
+            T = np.eye(4)
+            T[:3, :3] = Rotation.from_euler(axis, sign * PERTURBATION_DEG, degrees=True).as_matrix()
+            T[:3, 3] = center - T[:3, :3] @ center
+            init = asrs_native.worldToFsl(T, img_ref1, img_ref2)
+            starts.append((f"qform {axis}{sign * PERTURBATION_DEG:+d}", init, asrs_native.SCHEDULE))
+    return starts
+
+def _registerNative(img_ref1, img_ref2, init, schedule):
+    xform, _ = asrs_native.register(img_ref1, img_ref2, init=init, search=init is None, schedule=schedule)
+    return xform
+
+def _registerFlirt(ref1File, ref2File, init, schedule, scratch):
+    # FLIRT from init without search, or with its own search (init None), with its default
+    # sampling; a schedule starting coarser than the native one first runs FLIRT with the
+    # coarsest level as minimal sampling and refines that result
+    import os
+    import tempfile
+    from nipype.interfaces.fsl import FLIRT
+    with tempfile.TemporaryDirectory(dir=scratch) as run:
+        def flirt(init, name, **options):
+            options.update(in_file=ref1File, reference=ref2File, out_file=os.path.join(run, name + '.nii'),
+                           out_matrix_file=os.path.join(run, name + '.txt'), cost_func='corratio', dof=6)
+            if init is not None:
+                np.savetxt(os.path.join(run, name + '_init.txt'), init)
+                options.update(in_matrix_file=os.path.join(run, name + '_init.txt'), no_search=True)
+            return np.loadtxt(FLIRT(**options).run().outputs.out_matrix_file)
+        if schedule[0][0] > asrs_native.SCHEDULE[0][0]:
+            init = flirt(init, 'coarse', min_sampling=float(schedule[0][0]))
+        return flirt(init, 'out')
+
+def _difference(T, Tbest, center):
+    # displacement (mm) of center and rotation angle (degrees) between two world transforms
+    mm = np.linalg.norm((T @ np.r_[center, 1])[:3] - (Tbest @ np.r_[center, 1])[:3])
+    deg = np.degrees(Rotation.from_matrix(T[:3, :3] @ Tbest[:3, :3].T).magnitude())
+    return float(mm), float(deg)
+
+def multiStartRegister(ref1, ref2, backend='flirt', workers=None):
+    """
+    Register ref1 to ref2 from all startingPoints in parallel (processes for the native
+    backend, threads running FLIRT otherwise), returns the FLIRT matrix of the candidate
+    with the lowest cost and a report: {'best', 'candidates': [(name, cost, mm, deg)],
+    'agreeing', 'spread_mm', 'spread_deg'}, mm/deg relative to the best candidate.
+    """
+    import os
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    img_ref1, img_ref2 = [asrs_native.firstVolume(asrs.loadImage(img)) for img in (ref1, ref2)]
+    starts = startingPoints(img_ref1, img_ref2)
+    with tempfile.TemporaryDirectory(prefix='asrs_', dir=asrs.scratchParent()) as scratch:
+        if backend == 'native':
+            # daemonic processes (e.g. asrs_speculate) cannot have children, threads instead
+            daemonic = multiprocessing.current_process().daemon
+            with (ThreadPoolExecutor if daemonic else ProcessPoolExecutor)(max_workers=workers) as executor:
+                futures = [executor.submit(_registerNative, img_ref1, img_ref2, init, schedule)
+                           for _, init, schedule in starts]
+                xforms = [future.result() for future in futures]
+        elif backend == 'flirt':
+            from nipype.interfaces.fsl import FSLCommand
+            FSLCommand.set_default_output_type('NIFTI')
+            ref1File = asrs.imageFile(img_ref1, os.path.join(scratch, 'ref1.nii'))
+            ref2File = asrs.imageFile(img_ref2, os.path.join(scratch, 'ref2.nii'))
+            with ThreadPoolExecutor(max_workers=workers or len(starts)) as executor:
+                futures = [executor.submit(_registerFlirt, ref1File, ref2File, init, schedule, scratch)
+                           for _, init, schedule in starts]
+                xforms = [future.result() for future in futures]
+        else:
+            raise ValueError(f"Unknown registration backend: {backend}")
+    # common score: the finest level of the native registration
+    resolution, maxPoints = asrs_native.SCHEDULE[-1]
+    cost = asrs_native._CostFunction(asrs_native.pyramid(img_ref1, [(resolution, maxPoints)])[0], img_ref1,
+                                     asrs_native.pyramid(img_ref2, [(resolution, maxPoints)])[0],
+                                     img_ref2.affine, resolution, maxPoints)
+    worlds = [asrs_native.fslToWorld(xform, img_ref1, img_ref2) for xform in xforms]
+    costs = [float(cost(T)) for T in worlds]
+    best = int(np.argmin(costs))
+    center = asrs_native.centerOfMass(img_ref1)
+    differences = [_difference(T, worlds[best], center) for T in worlds]
+    agreeing = [d for d in differences if d[0] <= AGREEMENT_MM and d[1] <= AGREEMENT_DEG]
+    report = {'best': starts[best][0],
+              'candidates': [(name, c, mm, deg) for (name, _, _), c, (mm, deg) in zip(starts, costs, differences)],
+              'agreeing': len(agreeing),
+              # spread of the candidates agreeing with the best one
+              'spread_mm': max(mm for mm, _ in agreeing),
+              'spread_deg': max(deg for _, deg in agreeing)}
+    return np.asarray(xforms[best]), report
+
+def printReport(report):
+    print("Multi-start ref1 -> ref2 registration (cost, difference to best):")
+    for name, cost, mm, deg in report['candidates']:
+        mark = '*' if name == report['best'] else ' '
+        print(f" {mark} {name:<24} {cost:.4f}  {mm:6.2f} mm {deg:6.2f} deg")
+    print(f"  {report['agreeing']} of {len(report['candidates'])} starts agree with the best within " +
+          f"{AGREEMENT_MM} mm / {AGREEMENT_DEG} deg (spread {report['spread_mm']:.2f} mm / " +
+          f"{report['spread_deg']:.2f} deg)")
+
+def bestRegistration(ref1, ref2, backend='flirt', workers=None):
+    # multiStartRegister with the report printed, returns the FLIRT matrix ref1 -> ref2
+    xform, report = multiStartRegister(ref1, ref2, backend, workers)
+    printReport(report)
+    return xform
@@ -0,0 +1,278 @@
+#! /usr/bin/env python3
+""" In-process replacement for the FSL steps of asrs.registerOldSlabToNewRef.
+
+Rigid (6 DOF) registration using the correlation ratio on a multi-resolution pyramid,
+optimized with scipy. All matrices use the FLIRT convention (mapping between the scaled
+voxel coordinates given by asrs.voxelToFsl), so results can be used with asrs.flirtToSform
+exactly like FLIRT output.
+"""
+import numpy as np
+import nibabel as nb
+from scipy import ndimage, optimize
+from scipy.spatial.transform import Rotation
+from asrs import voxelToFsl, loadImage, timedStage, cropToSlab
+
+# resolutions (mm) of the registration pyramid and maximal number of sampled points per level
+SCHEDULE = ((8, None), (4, None), (2, 200000))
+# rotations (degrees) around each axis tried at the coarsest level when searching
+SEARCH_ANGLES = (-15, 0, 15)
+# pyramid of track (volume to volume registration)
+TRACK_SCHEDULE = ((4, 4000), (2, 10000))
+N_BINS = 64
+
+def firstVolume(img):
+    # first volume of a 3D or 4D image as 3D nibabel image, only the first volume is read
+    if len(img.shape) > 3:
+        data = _volumeMap(img)
+        if data is None:
+            data = np.asanyarray(img.dataobj[..., 0])
+        img = nb.Nifti1Image(data, img.affine, img.header)
+    return img
+
+def _volumeMap(img):
+    # read-only memory map of the first volume for uncompressed files without intensity
+    # scaling (nothing is read before the data is used), None otherwise
+    proxy = img.dataobj
+    if (not nb.is_proxy(proxy) or not isinstance(getattr(proxy, 'file_like', None), str) or
+            proxy.file_like.endswith(('.gz', '.bz2', '.zst')) or (proxy.slope, proxy.inter) != (1.0, 0.0)):
+        return None
+    return np.memmap(proxy.file_like, dtype=proxy.dtype, mode='r', offset=proxy.offset,
+                     shape=img.shape[:3], order=proxy.order)
+
+def fslToWorld(xform, srcImg, refImg):
+    # FLIRT matrix -> world (scanner mm) transform from src to ref
+    return np.asarray(refImg.affine @ np.linalg.inv(voxelToFsl(refImg)) @ np.asarray(xform) @
+                      voxelToFsl(srcImg) @ np.linalg.inv(srcImg.affine))
+
+def worldToFsl(T, srcImg, refImg):
+    # world (scanner mm) transform from src to ref -> FLIRT matrix
+    return np.asarray(voxelToFsl(refImg) @ np.linalg.inv(refImg.affine) @ T @
+                      srcImg.affine @ np.linalg.inv(voxelToFsl(srcImg)))
+
+def qformMatrix(srcImg, refImg):
+    # equivalent of FLIRT -usesqform -applyxfm: the matrix that only uses the image geometries
+    return worldToFsl(np.eye(4), srcImg, refImg)
+
+def resample(srcImg, refImg, xform, order=1):
+    # resample srcImg into the grid of refImg using FLIRT matrix xform (src -> ref),
+    # returns a 3D nibabel image with the geometry of refImg
+    srcImg, refImg = firstVolume(srcImg), firstVolume(refImg)
+    refToSrcVox = (np.linalg.inv(srcImg.affine) @ np.linalg.inv(fslToWorld(xform, srcImg, refImg)) @
+                   refImg.affine)
+    data = ndimage.affine_transform(np.asarray(srcImg.dataobj, dtype=np.float32), refToSrcVox,
+                                    output_shape=refImg.shape[:3], order=order, mode='constant', cval=0)
+    return nb.Nifti1Image(data, refImg.affine, refImg.header)
+
+def _smooth(data, zooms, fwhm):
+    sigma = [fwhm / 2.3548 / z if fwhm > z else 0 for z in zooms]
+    return ndimage.gaussian_filter(data, sigma) if any(sigma) else data
+
+def pyramid(img, schedule=SCHEDULE):
+    # smoothed copies of the image data, one per resolution of the schedule
+    data = np.asarray(firstVolume(img).dataobj, dtype=np.float32)
+    zooms = img.header.get_zooms()[:3]
+    return [_smooth(data, zooms, resolution) for resolution, _ in schedule]
+
+def _samplingGrid(srcData, srcImg, resolution, maxPoints, srcMask=None):
+    # voxel indices of the source sampled with the level resolution, at most maxPoints
+    zooms = np.array(srcImg.header.get_zooms()[:3])
+    step = np.maximum(1, np.round(resolution / zooms)).astype(int)
+    grid = np.stack(np.meshgrid(*[np.arange(0, n, s) for n, s in zip(srcData.shape, step)],
+                                indexing='ij'), axis=-1).reshape(-1, 3)
+    if srcMask is not None:
+        grid = grid[srcMask[tuple(grid.T)] > 0]
+    if maxPoints is not None and len(grid) > maxPoints:
+        grid = grid[np.random.default_rng(0).choice(len(grid), maxPoints, replace=False)]
+    return grid
+
+class _CostFunction:
+    """
+    Correlation ratio between the (smoothed) source sampled on a grid with the level
+    resolution and the (smoothed) reference interpolated at the transformed grid points.
+    """
+    def __init__(self, srcData, srcImg, refData, refAffine, resolution, maxPoints, srcMask=None,
+                 nBins=N_BINS):
+        grid = _samplingGrid(srcData, srcImg, resolution, maxPoints, srcMask)
+        values = srcData[tuple(grid.T)]
+        lo, hi = np.percentile(values, [1, 99])
+        self.bins = np.clip(((values - lo) / max(hi - lo, 1e-6) * nBins).astype(int), 0, nBins - 1)
+        self.nBins = nBins
+        self.points = srcImg.affine @ np.c_[grid, np.ones(len(grid))].T
+        self.refData = refData
+        self.refWorldToVox = np.linalg.inv(refAffine)
+        self.refShape = np.array(refData.shape)[:, None]
+
+    def __call__(self, T):
+        # T: world transform src -> ref
+        coords = (self.refWorldToVox @ T @ self.points)[:3]
+        inside = np.all((coords >= 0) & (coords <= self.refShape - 1), axis=0)
+        n = inside.sum()
+        if n < 0.05 * len(inside):
+            return 1.0
+        y = ndimage.map_coordinates(self.refData, coords[:, inside], order=1, mode='nearest')
+        bins = self.bins[inside]
+        nk = np.bincount(bins, minlength=self.nBins)
+        s1 = np.bincount(bins, weights=y, minlength=self.nBins)
+        s2 = np.bincount(bins, weights=y * y, minlength=self.nBins)
+        total = y.var() * n
+        if total <= 0:
+            return 1.0
+        used = nk > 0
+        within = np.sum(s2[used] - s1[used] ** 2 / nk[used])
+        return within / total
+
+class _Residuals:
+    """
+    Differences between the (smoothed) reference interpolated at the transformed grid points
+    and the best linear fit of it by the source values, for images with the same contrast.
+    """
+    def __init__(self, srcData, srcImg, refData, refAffine, resolution, maxPoints):
+        grid = _samplingGrid(srcData, srcImg, resolution, maxPoints)
+        values = srcData[tuple(grid.T)]
+        # orthonormal basis of the intensity fit (offset and scale)
+        self.basis, _ = np.linalg.qr(np.c_[np.ones(len(values)), values])
+        self.points = srcImg.affine @ np.c_[grid, np.ones(len(grid))].T
+        self.refData = refData
+        self.refWorldToVox = np.linalg.inv(refAffine)
+
+    def sample(self, T):
+        # T: world transform src -> ref
+        coords = (self.refWorldToVox @ T @ self.points)[:3]
+        return ndimage.map_coordinates(self.refData, coords, order=1, mode='nearest')
+
+    def __call__(self, T):
+        y = self.sample(T)
+        return y - self.basis @ (self.basis.T @ y)
+
+    def relative(self, T):
+        # norm of the residuals relative to the contrast of the reference
+        y = self.sample(T)
+        r = y - self.basis @ (self.basis.T @ y)
+        return float(np.linalg.norm(r) / max(np.linalg.norm(y - y.mean()), 1e-6))
+
+def _transform(params, center, T0):
+    # rigid transform (rotations in degrees around center, translations in mm) applied after T0
+    T = np.eye(4)
+    T[:3, :3] = Rotation.from_euler('xyz', params[:3], degrees=True).as_matrix()
+    T[:3, 3] = center + params[3:] - T[:3, :3] @ center
+    return T @ T0
+
+def centerOfMass(img):
+    # intensity weighted center of mass in world coordinates
+    data = np.asarray(firstVolume(img).dataobj, dtype=np.float32)
+    return (img.affine @ np.r_[ndimage.center_of_mass(np.clip(data, 0, None)), 1])[:3]
+
+def register(srcImg, refImg, init=None, search=True, schedule=SCHEDULE, srcPyramid=None, srcMask=None):
+    """
+    Rigid registration of srcImg to refImg (correlation ratio, 6 DOF).
+    init is an initial FLIRT matrix, without init the centers of mass are aligned.
+    srcPyramid can be a precomputed result of pyramid(srcImg, schedule),
+    srcMask restricts the cost to the voxels of srcImg where it is > 0.
+    Returns the FLIRT matrix (src -> ref) and the final cost.
+    """
+    srcImg, refImg = firstVolume(srcImg), firstVolume(refImg)
+    if init is None:
+        T0 = np.eye(4)
+        T0[:3, 3] = centerOfMass(refImg) - centerOfMass(srcImg)
+    else:
+        T0 = fslToWorld(init, srcImg, refImg)
+    if srcPyramid is None:
+        srcPyramid = pyramid(srcImg, schedule)
+    refPyramid = pyramid(refImg, schedule)
+    # rotations are around the center of the source (after the initial transform)
+    center = (T0 @ srcImg.affine @ np.r_[(np.array(srcImg.shape[:3]) - 1) / 2, 1])[:3]
+    params = np.zeros(6)
+    for level, (resolution, maxPoints) in enumerate(schedule):
+        cost = _CostFunction(srcPyramid[level], srcImg, refPyramid[level], refImg.affine,
+                             resolution, maxPoints, srcMask)
+        if level == 0 and search:
+            candidates = [np.array([rx, ry, rz, 0, 0, 0]) for rx in SEARCH_ANGLES
+                          for ry in SEARCH_ANGLES for rz in SEARCH_ANGLES]
+            params = min(candidates, key=lambda p: cost(_transform(p, center, T0)))
+        step = resolution / 4
+        result = optimize.minimize(lambda p: cost(_transform(p, center, T0)), params, method='Powell',
+                                   options={'xtol': 1e-2, 'ftol': 1e-5,
+                                            'direc': np.diag([step, step, step, step, step, step])})
+        params = result.x
+    return worldToFsl(_transform(params, center, T0), srcImg, refImg), float(result.fun)
+
+def track(srcImg, refImg, init, schedule=TRACK_SCHEDULE, srcPyramid=None, iterations=10, tolerance=0.01):
+    """
+    Fast rigid registration for small motion between images with the same contrast (e.g.
+    volumes of a time series): Gauss-Newton on the intensity differences, starting from the
+    FLIRT matrix init. srcPyramid can be a precomputed result of pyramid(srcImg, schedule).
+    Returns the FLIRT matrix (src -> ref) and the residual relative to the reference contrast.
+    """
+    srcImg, refImg = firstVolume(srcImg), firstVolume(refImg)
+    T0 = fslToWorld(init, srcImg, refImg)
+    if srcPyramid is None:
+        srcPyramid = pyramid(srcImg, schedule)
+    refPyramid = pyramid(refImg, schedule)
+    center = (T0 @ srcImg.affine @ np.r_[(np.array(srcImg.shape[:3]) - 1) / 2, 1])[:3]
+    params = np.zeros(6)
+    for level, (resolution, maxPoints) in enumerate(schedule):
+        residuals = _Residuals(srcPyramid[level], srcImg, refPyramid[level], refImg.affine,
+                               resolution, maxPoints)
+        for _ in range(iterations):
+            r = residuals(_transform(params, center, T0))
+            # forward differences, 0.1 degrees or mm per parameter
+            J = np.stack([(residuals(_transform(params + 0.1 * e, center, T0)) - r) / 0.1
+                          for e in np.eye(6)], axis=1)
+            step = np.linalg.lstsq(J, -r, rcond=None)[0]
+            params = params + step
+            if np.max(np.abs(step)) < tolerance:
+                break
+    T = _transform(params, center, T0)
+    return worldToFsl(T, srcImg, refImg), residuals.relative(T)
+
+def coverageMask(srcImg, refImg, xform):
+    # voxels of refImg inside the field of view of srcImg after applying xform (src -> ref)
+    srcImg = firstVolume(srcImg)
+    ones = nb.Nifti1Image(np.ones(srcImg.shape[:3], dtype=np.float32), srcImg.affine, srcImg.header)
+    return (resample(ones, refImg, xform).get_fdata(dtype=np.float32) > 0.5).astype(np.uint8)
+
+def slabReference(img_ref1, slab1):
+    # ref1 resampled into the (first volume of the) slab using the qforms only, the coverage
+    # mask of ref1 in the slab and the FLIRT matrix ref1 -> slab1
+    with timedStage('extract slab volume'):
+        img_slab1 = firstVolume(loadImage(slab1))
+    with timedStage('ref1 to slab1'):
+        ref1_to_slab1 = qformMatrix(img_ref1, img_slab1)
+        ref1_in_slab1 = resample(img_ref1, img_slab1, ref1_to_slab1)
+        slab1_mask = coverageMask(img_ref1, img_slab1, ref1_to_slab1)
+    return ref1_in_slab1, slab1_mask, ref1_to_slab1
+
+def fineTuneSlab(ref1_in_slab1, img_ref2, slab1_to_ref2_init, slab1_mask=None, srcPyramid=None,
+                 cropMargin=None):
+    # final registration of the slab-sampled ref1 to ref2, starting from slab1_to_ref2_init
+    crop_to_ref2 = np.eye(4)
+    if cropMargin is not None:
+        img_ref2, crop_to_ref2 = cropToSlab(img_ref2, ref1_in_slab1, slab1_to_ref2_init, cropMargin)
+        slab1_to_ref2_init = np.linalg.inv(crop_to_ref2) @ slab1_to_ref2_init
+    with timedStage('slab1 to ref2'):
+        slab1_to_ref2, _ = register(ref1_in_slab1, img_ref2, init=slab1_to_ref2_init, search=False,
+                                    srcPyramid=srcPyramid, srcMask=slab1_mask)
+    return np.matrix(crop_to_ref2 @ slab1_to_ref2)
+
+def registerOldSlabToNewRef(slab1, ref1, ref2, bundle=None, cropMargin=None, multiStart=False):
+    # same steps as the FLIRT chain in asrs.registerOldSlabToNewRef, without subprocesses or files,
+    # images can be given as file names or nibabel images, with a session 1 bundle (asrs_bundle)
+    # slab1 and ref1 are not needed and only the ref2 side is computed
+    img_ref2 = firstVolume(loadImage(ref2))
+    if bundle is None:
+        img_ref1 = firstVolume(loadImage(ref1))
+        ref1_in_slab1, slab1_mask, ref1_to_slab1 = slabReference(img_ref1, slab1)
+        ref1_pyramid = ref1_in_slab1_pyramid = None
+    else:
+        img_ref1, ref1_in_slab1, slab1_mask = bundle.ref1, bundle.ref1InSlab, bundle.slabMask
+        ref1_to_slab1 = qformMatrix(img_ref1, ref1_in_slab1)
+        ref1_pyramid, ref1_in_slab1_pyramid = bundle.pyramid('ref1'), bundle.pyramid('ref1InSlab')
+    with timedStage('ref1 to ref2'):
+        if multiStart:
+            import asrs_multistart
+            ref1_to_ref2 = asrs_multistart.bestRegistration(img_ref1, img_ref2, 'native')
+        else:
+            ref1_to_ref2, _ = register(img_ref1, img_ref2, srcPyramid=ref1_pyramid)
+    slab1_to_ref2_init = ref1_to_ref2 @ np.linalg.inv(ref1_to_slab1)
+    return fineTuneSlab(ref1_in_slab1, img_ref2, slab1_to_ref2_init, slab1_mask, ref1_in_slab1_pyramid,
+                        cropMargin)
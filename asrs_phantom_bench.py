@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import asrs
+import sys
+import os
+import json
+import shutil
+import struct
+import tempfile
+import time
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+from scipy.spatial.transform import Rotation
+""" Synthetic phantom benchmark of the ASRS pipeline.
+
+Generates a head-like phantom of random ellipsoids, samples ref1 and a 4D slab1 from it,
+and ref2 from the same phantom moved by a known rigid transform, so that the true slab
+position of session 2 is known. Runs asrs.asrs end to end and writes a JSON report with
+the wall time of every pipeline stage (see asrs.timedStage) and the error of the
+recovered Siemens protocol parameters.
+
+With --dicom, ref2 (and ref1 as a second series) are written as a DICOM export, which is
+indexed and converted like at the scanner (in-process, and with dcm2niix if installed). ref2
+carries a Siemens CSA header like scanner exports, ref1 does not; both in-process conversions
+are compared to the phantom images and the ref2 one to dcm2niix (dicom_checks in the report).
+
+Usage: asrs_phantom_bench.py [--backend flirt] [--in-memory] [--dicom] [--seed 0]
+                             [--rotation 5] [--translation 8] [--crop-margin MM] [--multi-start]
+                             [--out report.json]
+"""
+
+REF_SHAPE = (128, 150, 128)
+REF_VOXEL = 1.5
+SLAB_SHAPE = (100, 100, 20)
+SLAB_VOLUMES = 3
+
+def randomEllipsoids(rng, n=25):
+    # (center, radii, rotation about z in degrees, intensity): head, brain and n structures
+    ellipsoids = [(np.zeros(3), np.array([70, 90, 65]), 0, 300),
+                  (np.array([0, 0, 5]), np.array([60, 80, 55]), 0, 500)]
+    for _ in range(n):
+        ellipsoids.append((rng.uniform(-40, 40, 3), rng.uniform(5, 20, 3),
+                           rng.uniform(0, 180), rng.uniform(-300, 400)))
+    return ellipsoids
+
+def samplePhantom(ellipsoids, affine, shape, motion=np.eye(4)):
+    # phantom moved by motion (world to world) sampled on the voxel grid affine/shape
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), -1).reshape(-1, 3)
+    points = (np.linalg.inv(motion) @ affine @ np.c_[grid, np.ones(len(grid))].T)[:3].T
+    data = np.zeros(len(points))
+    for center, radii, angle, value in ellipsoids:
+        R = Rotation.from_euler('z', angle, degrees=True).as_matrix()
+        q = (points - center) @ R / radii
+        data += value * (np.sum(q * q, axis=1) <= 1)
+    data = ndimage.gaussian_filter(data.reshape(shape), 0.7)
+    return nb.Nifti1Image(data.astype(np.float32), affine)
+
+def gridAffine(voxelSizes, shape, R=np.eye(3), center=np.zeros(3)):
+    affine = np.eye(4)
+    affine[:3, :3] = R @ np.diag(voxelSizes)
+    affine[:3, 3] = center - affine[:3, :3] @ ((np.array(shape) - 1) / 2)
+    return affine
+
+def rigidMotion(rng, rotation, translation):
+    # rotation (degrees) and translation (mm) of the given size about/along random axes
+    axis = rng.normal(size=3)
+    direction = rng.normal(size=3)
+    motion = np.eye(4)
+    motion[:3, :3] = Rotation.from_rotvec(np.radians(rotation) * axis / np.linalg.norm(axis)).as_matrix()
+    motion[:3, 3] = translation * direction / np.linalg.norm(direction)
+    return motion
+
+def csaHeader(tags):
+    # minimal Siemens CSA2 (SV10) header with numeric tags {name: values}
+    header = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(tags), 77)
+    for name, values in tags.items():
+        header += struct.pack('<64si4s3i', name.encode(), len(values), b'FD\x00\x00', 4, len(values), 77)
+        for value in values:
+            item = repr(float(value)).encode() + b'\x00'
+            header += struct.pack('<4i', len(item), len(item), 77, len(item)) + item + b'\x00' * (-len(item) % 4)
+    return header
+
+def writeDicomSeries(img, outDir, seriesNumber, protocolName, sequenceName, csa=False):
+    # single frame MR series of a 3D image in dcm2niix voxel convention (see asrs.loadFromDicomSeries),
+    # with csa the files carry the CSA image header (SliceNormalVector) of Siemens exports
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian, MRImageStorage
+    os.makedirs(outDir, exist_ok=True)
+    data = np.clip(np.round(np.asarray(img.dataobj)), 0, 65535).astype(np.uint16)
+    lps = np.diag([-1, -1, 1, 1]) @ img.affine
+    nI, nJ, nK = data.shape
+    dI, dJ, dK = np.linalg.norm(lps[:3, :3], axis=0)
+    orientation = np.concatenate([lps[:3, 0] / dI, -lps[:3, 1] / dJ])
+    seriesUid, studyUid = generate_uid(), generate_uid()
+    for k in range(nK):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = MRImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID, ds.SOPInstanceUID = MRImageStorage, meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'MR'
+        ds.StudyInstanceUID, ds.SeriesInstanceUID = studyUid, seriesUid
+        ds.SeriesNumber, ds.InstanceNumber = seriesNumber, k + 1
+        ds.ProtocolName = ds.SeriesDescription = protocolName
+        ds.SequenceName = sequenceName
+        ds.AcquisitionDate, ds.AcquisitionTime = '20260101', f"12{seriesNumber:02d}00"
+        ds.ImagePositionPatient = [float(x) for x in (lps @ [0, nJ - 1, k, 1])[:3]]
+        ds.ImageOrientationPatient = [float(x) for x in orientation]
+        ds.PixelSpacing = [float(dJ), float(dI)]
+        ds.SliceThickness = float(dK)
+        if csa:
+            ds.Manufacturer = 'SIEMENS'
+            ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA HEADER')
+            ds.add_new((0x0029, 0x1010), 'OB',
+                       csaHeader({'SliceNormalVector': np.cross(orientation[:3], orientation[3:])}))
+        pixels = data[:, ::-1, k].T
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.PixelData = np.ascontiguousarray(pixels).tobytes()
+        ds.save_as(os.path.join(outDir, f"{seriesNumber:04d}_{k + 1:04d}.dcm"), enforce_file_format=True)
+
+def conversionErrors(img, reference, canonical=False):
+    # largest differences of a converted series to a reference image (affine in mm, intensities),
+    # with canonical both are compared in RAS voxel order (the phantom's voxel order need not
+    # be the one of dcm2niix); dcm2niix stacks slices along the DICOM normal (row x column),
+    # which always gives a negative determinant
+    errors = {'dcm2niix_handedness': bool(np.linalg.det(img.affine[:3, :3]) < 0)}
+    if canonical:
+        img, reference = nb.as_closest_canonical(img), nb.as_closest_canonical(reference)
+    if img.shape != reference.shape:
+        return dict(errors, shape=list(img.shape), expected_shape=list(reference.shape))
+    data = np.asarray(img.dataobj, dtype=np.float64)
+    return dict(errors, affine_mm=float(np.max(np.abs(img.affine - reference.affine))),
+                data=float(np.max(np.abs(data - np.asarray(reference.dataobj, dtype=np.float64)))))
+
+def loadRef2FromDicom(img_ref1, img_ref2, exportDir, timings, checks):
+    # writes ref1 and ref2 (with CSA header) as DICOM export, indexes it and converts the ref2
+    # series; checks gets the errors of the conversions (see conversionErrors)
+    from dicom_series_selector import DicomHeaderIndex, group_acquisitions, calculate_series_crc
+    start = time.perf_counter()
+    writeDicomSeries(img_ref1, exportDir, 1, 'phantom_ref', '*tfl3d1')
+    writeDicomSeries(img_ref2, exportDir, 2, 'phantom_ref', '*tfl3d1', csa=True)
+    timings['dicom write'] = time.perf_counter() - start
+    start = time.perf_counter()
+    index = DicomHeaderIndex(exportDir, index_path=os.path.join(exportDir, 'index.json'))
+    index.refresh()
+    acquisitions = group_acquisitions(index.series_dict())
+    timings['dicom index'] = time.perf_counter() - start
+    series = {files[0][1].SeriesNumber: files for _, series_list in acquisitions for _, files in series_list}
+    img = asrs.loadFromDicomSeries(series[2])
+    # the phantom as written: integer intensities
+    written = [nb.Nifti1Image(np.clip(np.round(np.asarray(ref.dataobj)), 0, 65535), ref.affine)
+               for ref in (img_ref1, img_ref2)]
+    checks['in-process'] = conversionErrors(asrs._loadFromDicomSeries(series[1]), written[0], canonical=True)
+    checks['in-process, CSA'] = conversionErrors(img, written[1], canonical=True)
+    if shutil.which('dcm2niix'):
+        converted = asrs.loadFromDicomExport(exportDir, calculate_series_crc(series[2][0][1]))
+        converted = converted if isinstance(converted, str) else converted[0]
+        checks['dcm2niix, CSA'] = conversionErrors(img, nb.load(converted))
+    return img
+
+def protocolErrors(truth, results):
+    # per orientation type (matched by rotation names) errors of the recovered parameters
+    errors = []
+    for row in truth:
+        found = [r for r in results if (r[1], r[3]) == (str(row['rot1']), str(row['rot2']))]
+        if not found:
+            errors.append({'orientation': f"{row['rot1']} {row['rot2']}", 'found': False})
+            continue
+        position, _, angle1, _, angle2, peAngles = found[0]
+        peError = (peAngles[0] - row['peAngles'][0] + 180) % 360 - 180
+        errors.append({'orientation': f"{row['rot1']} {row['rot2']}", 'found': True,
+                       'position_mm': float(np.max(np.abs(np.array(position) - row['position']))),
+                       'angle1_deg': float(abs(angle1 - row['angle1'])),
+                       'angle2_deg': float(abs(angle2 - row['angle2'])),
+                       'pe_deg': float(abs(peError))})
+    return errors
+
+def runBenchmark(backend='flirt', inMemory=False, dicom=False, seed=0, rotation=5.0, translation=8.0,
+                 cropMargin=None, multiStart=False):
+    rng = np.random.default_rng(seed)
+    ellipsoids = randomEllipsoids(rng)
+    motion = rigidMotion(rng, rotation, translation)
+    refAffine = gridAffine([REF_VOXEL] * 3, REF_SHAPE)
+    # oblique slab with a left-right flipped voxel grid, as written by dcm2niix
+    slabRotation = Rotation.from_euler('xy', [rng.uniform(-25, 25), rng.uniform(-10, 10)],
+                                       degrees=True).as_matrix()
+    slabAffine = gridAffine([-1.5, 1.5, 1.5], SLAB_SHAPE, slabRotation, rng.uniform(-10, 10, 3))
+    start = time.perf_counter()
+    img_ref1 = samplePhantom(ellipsoids, refAffine, REF_SHAPE)
+    img_ref2 = samplePhantom(ellipsoids, refAffine, REF_SHAPE, motion)
+    slab = np.asarray(samplePhantom(ellipsoids, slabAffine, SLAB_SHAPE).dataobj)
+    img_slab1 = nb.Nifti1Image(np.stack([slab] * SLAB_VOLUMES, axis=-1), slabAffine)
+    t_phantom = time.perf_counter() - start
+    truth = asrs.qform2SiemensProtocolBatch(motion @ slabAffine, SLAB_SHAPE)
+
+    timings = asrs.stageTimings = {}
+    dicomChecks = {}
+    cwd = os.getcwd()
+    # cached results (asrs_cache) would hide the stages being measured
+    cacheSize = os.environ.get('ASRS_CACHE_MAX_MB')
+    os.environ['ASRS_CACHE_MAX_MB'] = '0'
+    try:
+        with tempfile.TemporaryDirectory(prefix='asrs_bench_') as workDir:
+            # the FLIRT chain writes its intermediate files into the working directory
+            os.chdir(workDir)
+            for name, img in [('slab1.nii', img_slab1), ('ref1.nii', img_ref1), ('ref2.nii', img_ref2)]:
+                for xformSetter in (img.set_qform, img.set_sform):
+                    xformSetter(img.affine, code=1)
+                nb.save(img, name)
+            start = time.perf_counter()
+            ref2 = loadRef2FromDicom(img_ref1, img_ref2, 'dicom', timings, dicomChecks) if dicom else 'ref2.nii'
+            results = asrs.asrs('slab1.nii', 'ref1.nii', ref2, backend, inMemory, cropMargin=cropMargin,
+                                multiStart=multiStart)
+            t_total = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        asrs.stageTimings = None
+        if cacheSize is None:
+            del os.environ['ASRS_CACHE_MAX_MB']
+        else:
+            os.environ['ASRS_CACHE_MAX_MB'] = cacheSize
+    errors = protocolErrors(truth, results)
+    found = [e for e in errors if e['found']]
+    return {'backend': backend, 'inMemory': inMemory, 'dicom': dicom, 'seed': seed, 'cropMargin': cropMargin,
+            'multiStart': multiStart,
+            'motion': {'rotation_deg': rotation, 'translation_mm': translation,
+                       'matrix': motion.tolist()},
+            'phantom_s': t_phantom,
+            'stages_s': timings,
+            'dicom_checks': dicomChecks if dicom else None,
+            'dicom_ok': all(c['dcm2niix_handedness'] and c.get('affine_mm', 1) < 1e-3 and c.get('data', 1) < 0.5
+                            for c in dicomChecks.values()) if dicom else None,
+            'total_s': t_total,
+            'errors': errors,
+            'max_position_error_mm': max((e['position_mm'] for e in found), default=None),
+            'max_angle_error_deg': max((max(e['angle1_deg'], e['angle2_deg']) for e in found),
+                                       default=None)}
+
+if __name__ == "__main__":
+    backend = asrs.popOption(sys.argv, '--backend', 'flirt')
+    inMemory = asrs.popFlag(sys.argv, '--in-memory')
+    dicom = asrs.popFlag(sys.argv, '--dicom')
+    seed = int(asrs.popOption(sys.argv, '--seed', 0))
+    rotation = float(asrs.popOption(sys.argv, '--rotation', 5.0))
+    translation = float(asrs.popOption(sys.argv, '--translation', 8.0))
+    cropMargin = asrs.popOption(sys.argv, '--crop-margin')
+    cropMargin = float(cropMargin) if cropMargin is not None else None
+    multiStart = asrs.popFlag(sys.argv, '--multi-start')
+    out = asrs.popOption(sys.argv, '--out')
+    if len(sys.argv) != 1:
+        print("Usage: asrs_phantom_bench.py [--backend flirt] [--in-memory] [--dicom] [--seed 0] " +
+              "[--rotation 5] [--translation 8] [--crop-margin MM] [--multi-start] [--out report.json]")
+        sys.exit(1)
+    report = runBenchmark(backend, inMemory, dicom, seed, rotation, translation, cropMargin, multiStart)
+    if out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {out}")
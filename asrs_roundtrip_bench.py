@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import asrs
+import sys
+import time
+import numpy as np
+""" Round-trip verification of the Siemens protocol <-> qform conversion.
+
+Draws random protocols (all six orientation types, tilts within the range reported by
+qform2SiemensProtocol, any PE angle, random positions, matrix and voxel sizes), builds
+their qforms with siemensProtocol2qform and checks that qform2SiemensProtocolBatch
+recovers exactly the same parameters. Prints the timing of both directions.
+
+Usage: asrs_roundtrip_bench.py [N=200000] [--seed 0]
+"""
+
+def randomProtocols(N, rng):
+    # parameters on the 0.1 grid used by the scanner (and qform2SiemensProtocol)
+    orientation = rng.integers(0, len(asrs.ORIENTATIONS), N)
+    angle1 = rng.integers(-450, 451, N) / 10
+    angle2 = np.round(rng.uniform(-1, 1, N) * np.abs(angle1), 1)
+    peAngle = rng.integers(-1800, 1800, N) / 10
+    position = rng.integers(-1000, 1001, (N,3)) / 10
+    dims = rng.integers(16, 257, (N,3))
+    voxelSizes = rng.integers(5, 41, (N,3)) / 10
+    return position, orientation, angle1, angle2, peAngle, dims, voxelSizes
+
+def checkRoundTrip(N, seed=0):
+    # returns the number of failed round trips
+    rng = np.random.default_rng(seed)
+    position, orientation, angle1, angle2, peAngle, dims, voxelSizes = randomProtocols(N, rng)
+    start = time.perf_counter()
+    qforms = asrs.siemensProtocol2qform(position, orientation, angle1, angle2, peAngle, dims, voxelSizes)
+    t_inverse = time.perf_counter() - start
+    start = time.perf_counter()
+    rows = asrs.qform2SiemensProtocolBatch(qforms, dims)
+    t_forward = time.perf_counter() - start
+    # the row reported for the orientation type the qform was built with
+    rows = rows[rows['orientation'] == orientation[rows['index']]]
+    found = np.zeros(N, dtype=bool)
+    found[rows['index']] = True
+    idx = rows['index']
+    ok = (np.all(np.isclose(rows['position'], position[idx]), axis=1) &
+          np.isclose(rows['angle1'], angle1[idx]) & np.isclose(rows['angle2'], angle2[idx]) &
+          np.isclose(rows['peAngles'][:,0], peAngle[idx]))
+    failed = np.union1d(np.flatnonzero(~found), idx[~ok])
+    print(f"{N} protocols: inverse {t_inverse:.2f} s ({N/t_inverse:,.0f}/s), " +
+          f"forward {t_forward:.2f} s ({N/t_forward:,.0f}/s)")
+    for o, (_, _, rot1Str, rot2Str, _, _) in enumerate(asrs.ORIENTATIONS):
+        n = np.sum(orientation == o)
+        print(f"  {rot1Str} {rot2Str}: {n} protocols, {np.sum(orientation[failed] == o)} failed")
+    for i in failed[:10]:
+        print(f"  failed: orientation {orientation[i]} position {position[i]} angles " +
+              f"{angle1[i]} {angle2[i]} PE {peAngle[i]} dims {dims[i]} voxel sizes {voxelSizes[i]}")
+    return len(failed)
+
+if __name__ == "__main__":
+    seed = int(asrs.popOption(sys.argv, '--seed', 0))
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    if checkRoundTrip(N, seed):
+        sys.exit(1)
@@ -0,0 +1,143 @@
+""" Speculative conversion and registration for the series menu of asrs_gui.py.
+
+While the operator is still in the menu, the most likely session 2 reference series
+(dicom_series_selector.predict_series) is converted and registered in a worker process.
+The export is followed in a background thread (regular header index refreshes), so
+this starts as soon as the series is complete, also while the menu is idle. If the operator
+selects that series, the result is (almost) ready; if another series is selected or the
+guess changes, the speculative work is cancelled.
+"""
+import os
+import sys
+import queue
+import tempfile
+import threading
+import time
+import multiprocessing
+import asrs
+from dicom_series_selector import DicomHeaderIndex, group_acquisitions, predict_series, calculate_series_crc
+
+def _speculate(results, dicomExportPath, files, slab1, ref1, backend, inMemory, bundle, cropMargin,
+               multiStart):
+    # worker process, same steps as asrs_gui after the selection; progress and the result
+    # (asrsMatrices) are sent through results, output would disturb the menu
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        results.put(('converting', None))
+        ref2 = asrs.loadSelectedSeries(dicomExportPath, calculate_series_crc(files[0][1]), files)
+        results.put(('registering', None))
+        # the FLIRT chain writes into the working directory, which the real run may use later
+        with tempfile.TemporaryDirectory(prefix='asrs_speculate_', dir=asrs.scratchParent()) as scratch:
+            os.chdir(scratch)
+            results.put(('done', asrs.asrsMatrices(slab1, ref1, ref2, backend, inMemory, bundle, cropMargin,
+                                                   multiStart)))
+    except Exception as e:
+        results.put(('failed', str(e)))
+
+class SpeculativeRegistration:
+    """
+    Background conversion and registration of the predicted series, to be passed as
+    speculator to dicom_series_selector. slab1, ref1, backend, inMemory, bundle and
+    cropMargin and multiStart are as for asrs.asrs, protocolName/sequenceName identify the reference.
+    """
+    def __init__(self, dicomExportPath, slab1, ref1, backend='flirt', inMemory=False, bundle=None,
+                 cropMargin=None, protocolName=None, sequenceName=None, quietPeriod=3.0, multiStart=False):
+        self.dicomExportPath = dicomExportPath
+        # the worker runs in its own directory
+        self.args = ([os.path.abspath(f) if isinstance(f, str) else f for f in (slab1, ref1)] +
+                     [backend, inMemory, bundle, cropMargin, multiStart])
+        self.protocolName = protocolName
+        self.sequenceName = sequenceName
+        self.quietPeriod = quietPeriod
+        self.process = None
+        self.seriesUid = self.paths = None
+        self.state = self.result = None
+        # update is called from the menu and from the follow thread
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+
+    def follow(self, pollInterval=1.0):
+        """
+        Keep the prediction up to date in a background thread until take is called: every
+        pollInterval seconds the header index is refreshed (not stored) and update is called,
+        the prediction also changes without new files once the quiet period has passed.
+        """
+        threading.Thread(target=self._follow, args=(pollInterval,), daemon=True).start()
+
+    def _follow(self, pollInterval):
+        index = DicomHeaderIndex(self.dicomExportPath)
+        while not self.stopped.is_set():
+            index.refresh(save=False)
+            self.update(group_acquisitions(index.series_dict()))
+            self.stopped.wait(pollInterval)
+
+    def update(self, sorted_acquisitions):
+        # (re)start the speculative run if the predicted series or its files changed
+        guess = predict_series(sorted_acquisitions, self.protocolName, self.sequenceName, self.quietPeriod)
+        if guess is None:
+            return
+        seriesUid, files = guess
+        paths = frozenset(path for path, _ in files)
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            if (seriesUid, paths) == (self.seriesUid, self.paths) and self.state != 'failed':
+                return
+            self.cancel()
+            self.seriesUid, self.paths = seriesUid, paths
+            self.state, self.result, self.start = 'starting', None, time.monotonic()
+            self.results = multiprocessing.Queue()
+            self.process = multiprocessing.Process(target=_speculate, daemon=True,
+                                                   args=(self.results, self.dicomExportPath, files, *self.args))
+            self.process.start()
+
+    def poll(self, timeout=None):
+        # collect progress messages of the worker, waits up to timeout for the first one
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                while True:
+                    state, result = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+                    timeout = None
+                    self.state, self.result = state, result
+            except queue.Empty:
+                pass
+            if self.state not in ('done', 'failed') and not self.process.is_alive() and self.results.empty():
+                self.state = 'failed'
+
+    def status(self, seriesUid):
+        # progress text for the menu
+        with self.lock:
+            if seriesUid != self.seriesUid:
+                return None
+            self.poll()
+            if self.state in ('done', 'failed'):
+                return f"predicted, {'ready' if self.state == 'done' else 'failed'}"
+            return f"predicted, {self.state} ({time.monotonic() - self.start:.0f} s)"
+
+    def take(self, files):
+        """
+        Result (as asrs.asrsMatrices) for the selected files: waits for the speculative
+        run if it works on exactly these files, otherwise cancels it and returns None.
+        Stops following the export.
+        """
+        self.stopped.set()
+        with self.lock:
+            if self.process is None or frozenset(path for path, _ in files) != self.paths:
+                self.cancel()
+                return None
+            while self.state not in ('done', 'failed'):
+                self.poll(timeout=0.5)
+            result = self.result if self.state == 'done' else None
+            self.cancel()
+            return result
+
+    def cancel(self):
+        with self.lock:
+            if self.process is not None:
+                if self.process.is_alive():
+                    self.process.terminate()
+                self.process.join()
+                self.process = None
+                self.results.close()
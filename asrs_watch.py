@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import asrs
+import sys
+import os
+import argparse
+import numpy as np
+import nibabel as nb
+from dicom_series_selector import SeriesWatcher, reference_series_info, calculate_series_crc
+""" Headless variant of asrs_gui.py, it assumes that:
+- there are two locally available nifti files from sessions 1: ref1.nii and slab1.nii
+- there is a dicom realtime export folder in which the reference images of session 2 will arrive
+- the session 2 reference uses the same protocol (ProtocolName/SequenceName) as ref1.nii,
+  these are read from ref1.json (written by dcm2niix) or have to be given on the command line
+
+The export folder is followed (inotify if inotify_simple is installed, polling otherwise) and as
+soon as a matching series is complete, it is converted and asrs computes the new slab positioning.
+
+Usage: asrs_watch.py dicomExportPath [--protocol NAME] [--sequence NAME] [--expected-count N] [--quiet SECONDS]
+                     [--backend flirt|native] [--in-memory] [--bundle bundle.npz]
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ASRS as soon as the session 2 reference has arrived")
+    parser.add_argument('dicomExportPath')
+    parser.add_argument('--protocol', help="ProtocolName of the reference (default: from ref1.json)")
+    parser.add_argument('--sequence', help="SequenceName of the reference (default: from ref1.json)")
+    parser.add_argument('--expected-count', type=int,
+                        help="number of files of a complete reference series " +
+                        "(default: number of slices of ref1.nii; not used for mosaic/multi-frame series, " +
+                        "0 to only wait for the quiet period)")
+    parser.add_argument('--quiet', type=float, default=3.0,
+                        help="seconds without new files before a series is considered complete")
+    parser.add_argument('--include-existing', action='store_true',
+                        help="also consider series that are already complete in the export folder")
+    parser.add_argument('--backend', default='flirt', choices=['flirt', 'native'],
+                        help="registration backend")
+    parser.add_argument('--bundle', help="session 1 bundle (asrs_bundle.py prepare) to use instead of " +
+                        "ref1.nii and slab1.nii")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="keep intermediate files out of the working directory (FLIRT backend)")
+    parser.add_argument('--crop-margin', type=float,
+                        help="crop ref2 to the slab plus this margin (mm) for the final registration")
+    parser.add_argument('--multi-start', action='store_true',
+                        help="register ref1 to ref2 from several starting points and use the best")
+    args = parser.parse_args()
+
+    dicomExportPath = args.dicomExportPath
+    if not os.path.exists(dicomExportPath) or not os.path.isdir(dicomExportPath):
+        print("Error: dicomExportPath does not exist or is not a folder")
+        sys.exit(1)
+    slab1 = ref1 = bundle = None
+    if args.bundle is not None:
+        import asrs_bundle
+        bundle = asrs_bundle.loadBundle(args.bundle)
+        protocol_name, sequence_name = bundle.metadata['protocol'], bundle.metadata['sequence']
+        ref1_shape = bundle.metadata['ref1Shape']
+    else:
+        for name in ['slab1', 'ref1']:
+            if not os.path.exists(f"{name}.nii"):
+                print(f"Error: {name}.nii not found in current folder")
+                sys.exit(1)
+            if os.path.exists(f"{name}.nii.gz"):
+                print(f"Error: {name}.nii.gz (in addition to {name}.nii) found in current folder, please delete")
+                sys.exit(1)
+        slab1 = 'slab1.nii'
+        ref1 = 'ref1.nii'
+        protocol_name, sequence_name = reference_series_info(ref1)
+        ref1_shape = nb.load(ref1).shape
+
+    protocol_name = args.protocol or protocol_name
+    sequence_name = args.sequence or sequence_name
+    if protocol_name is None:
+        print("Error: ProtocolName of the reference unknown (no ref1.json), please use --protocol")
+        sys.exit(1)
+    expected_count = args.expected_count
+    if expected_count is None:
+        # dcm2niix stacks 2D images along the 3rd dimension; for mosaic/multi-frame exports
+        # the watcher ignores the count and waits for the quiet period
+        expected_count = int(np.prod(ref1_shape[2:]))
+
+    watcher = SeriesWatcher(dicomExportPath, protocol_name, sequence_name,
+                            expected_count=expected_count, quiet_period=args.quiet,
+                            include_existing=args.include_existing)
+    mode = "inotify" if watcher.follower.inotify is not None else "polling"
+    print(f"Waiting for {protocol_name} ({sequence_name}) with {expected_count or '?'} files " +
+          f"in {dicomExportPath} ({mode})...")
+    series_uid, files = watcher.wait()
+    first_ds = files[0][1]
+    print(f"Series {getattr(first_ds, 'SeriesNumber', 'N/A')} complete ({len(files)} files)")
+    ref2 = asrs.loadSelectedSeries(dicomExportPath, calculate_series_crc(first_ds), files)
+    print("Running ASRS...")
+    asrs.asrs(slab1, ref1, ref2, args.backend, args.in_memory, bundle, args.crop_margin, args.multi_start)
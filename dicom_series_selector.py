@@ -1,6 +1,20 @@
 #!/usr/bin/env python3
+import os
+import json
 import zlib
+import sys
+import time
+import tempfile
 import curses
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# DICOM attributes kept in the header index, bump INDEX_VERSION when changing them
+SERIES_TAGS = ('SeriesInstanceUID', 'SeriesNumber', 'ProtocolName', 'SequenceName',
+               'SeriesDescription', 'AcquisitionDate', 'AcquisitionTime')
+INDEX_VERSION = 2
+# below this number of new files, headers are parsed without starting a worker pool
+PARALLEL_SCAN_MIN_FILES = 200
 
 def calculate_series_crc(ds):
     """
@@ -14,13 +28,444 @@ def calculate_series_crc(ds):
         return crc
     return 0
 
-def interactive_menu(stdscr, sorted_acquisitions):
+def cache_dir():
+    """
+    Directory for files ASRS keeps between runs (can be set with ASRS_CACHE_DIR).
+    """
+    return os.environ.get('ASRS_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'asrs'))
+
+def _header_value(value):
+    # convert pydicom values to plain (json serializable) python types
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    # attribute strings repeat for every file of a series, share them
+    return sys.intern(str(value))
+
+class DicomHeader:
+    """
+    Compact record of the SERIES_TAGS attributes of a single file.
+    Attributes missing from the file are left unset, so that
+    getattr(header, tag, default) behaves as it does for a pydicom Dataset.
+    """
+    __slots__ = SERIES_TAGS
+
+    def __init__(self, values):
+        for tag, value in zip(SERIES_TAGS, values):
+            if value is not None:
+                setattr(self, tag, value)
+
+    def values(self):
+        return [getattr(self, tag, None) for tag in SERIES_TAGS]
+
+def read_header(file_path):
+    """
+    Parse only the attributes listed in SERIES_TAGS from a single file.
+    Returns a list of values in SERIES_TAGS order (None for missing attributes)
+    or None if the file is not a DICOM image belonging to a series.
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    try:
+        ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=list(SERIES_TAGS))
+    except (InvalidDicomError, OSError):
+        return None
+    if 'SeriesInstanceUID' not in ds:
+        return None
+    values = []
+    for tag in SERIES_TAGS:
+        value = ds.get(tag)
+        # empty elements are treated as missing
+        values.append(_header_value(value) if value is not None and value != '' else None)
+    return values
+
+def read_headers(file_paths, workers=None):
+    """
+    Parse the headers of many files, using a process pool for large numbers of files.
+    Returns a list of read_header results in the order of file_paths.
+    """
+    if len(file_paths) < PARALLEL_SCAN_MIN_FILES or workers == 1:
+        return [read_header(file_path) for file_path in file_paths]
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(256, len(file_paths) // (4 * workers)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_header, file_paths, chunksize=chunksize))
+
+class DicomHeaderIndex:
+    """
+    Persistent index of the parsed headers of all files in a DICOM export directory.
+
+    Entries are keyed on file path and validated by file size and modification time,
+    so a refresh only parses files that are new or have changed since the last scan.
+    The index is stored in the ASRS cache directory and survives restarts.
+    """
+    def __init__(self, dicom_dir, index_path=None, workers=None):
+        self.dicom_dir = os.path.abspath(dicom_dir)
+        if index_path is None:
+            key = zlib.crc32(self.dicom_dir.encode('utf-8')) & 0xFFFFFFFF
+            index_path = os.path.join(cache_dir(), f"dicom_index_{key:08x}.json")
+        self.index_path = index_path
+        self.workers = workers
+        # file path -> (size, mtime_ns, DicomHeader or None for non-DICOM files)
+        self.entries = {}
+        # series uid -> {file path: header}
+        self._series = defaultdict(dict)
+        self._sorted_series = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get('version') != INDEX_VERSION or stored.get('dicom_dir') != self.dicom_dir:
+            return
+        for file_path, (size, mtime_ns, values) in stored['entries'].items():
+            self._add(file_path, size, mtime_ns, values)
+
+    def save(self):
+        index_dir = os.path.dirname(self.index_path)
+        os.makedirs(index_dir, exist_ok=True)
+        # unique per call, several indexes of the same export may be saved concurrently
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir, prefix=os.path.basename(self.index_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': INDEX_VERSION,
+                           'dicom_dir': self.dicom_dir,
+                           'entries': {file_path: (size, mtime_ns, header and header.values())
+                                       for file_path, (size, mtime_ns, header) in self.entries.items()}}, f)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _add(self, file_path, size, mtime_ns, values):
+        header = DicomHeader(values) if values is not None else None
+        self.entries[file_path] = (size, mtime_ns, header)
+        if header is not None:
+            series_uid = header.SeriesInstanceUID
+            self._series[series_uid][file_path] = header
+            self._sorted_series.pop(series_uid, None)
+
+    def _remove(self, file_path):
+        _, _, header = self.entries.pop(file_path)
+        if header is not None:
+            series_uid = header.SeriesInstanceUID
+            del self._series[series_uid][file_path]
+            if not self._series[series_uid]:
+                del self._series[series_uid]
+            self._sorted_series.pop(series_uid, None)
+
+    def _walk(self):
+        # yields (path, size, mtime_ns) for all files below dicom_dir
+        for root, _, files in os.walk(self.dicom_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                yield file_path, st.st_size, st.st_mtime_ns
+
+    def refresh(self, save=True):
+        """
+        Rescan the export directory, parse new or changed files, drop vanished ones and store
+        the index unless save is False. Returns the number of files that had to be parsed.
+        """
+        seen = set()
+        changed = []
+        for file_path, size, mtime_ns in self._walk():
+            seen.add(file_path)
+            entry = self.entries.get(file_path)
+            if entry is None or entry[0] != size or entry[1] != mtime_ns:
+                changed.append((file_path, size, mtime_ns))
+        vanished = [file_path for file_path in self.entries if file_path not in seen]
+        for file_path in vanished:
+            self._remove(file_path)
+        headers = read_headers([file_path for file_path, _, _ in changed], self.workers)
+        for (file_path, size, mtime_ns), values in zip(changed, headers):
+            if file_path in self.entries:
+                self._remove(file_path)
+            self._add(file_path, size, mtime_ns, values)
+        if save and (changed or vanished):
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Warning: could not save DICOM header index: {e}")
+        return len(changed)
+
+    def series_dict(self):
+        """
+        Returns a dict mapping series uid to a list of (file_path, header) tuples,
+        sorted by file path.
+        """
+        for series_uid, files in self._series.items():
+            if series_uid not in self._sorted_series:
+                self._sorted_series[series_uid] = sorted(files.items())
+        return {series_uid: self._sorted_series[series_uid] for series_uid in self._series}
+
+def group_acquisitions(series_dict):
+    """
+    Group series by AcquisitionDate and AcquisitionTime.
+    Returns a list of (protocol_name, [(series_uid, files), ...]) sorted by acquisition
+    date/time, with series within each acquisition sorted by series number.
+    """
+    acquisition_groups = defaultdict(list)
+    for series_uid, files in series_dict.items():
+        # Sort files alphabetically to get consistent first file
+        sorted_files = sorted(files, key=lambda x: x[0])
+        first_ds = sorted_files[0][1]
+        acquisition_date = getattr(first_ds, 'AcquisitionDate', '')
+        acquisition_time = getattr(first_ds, 'AcquisitionTime', '')
+        protocol_name = getattr(first_ds, 'ProtocolName', None)
+        series_number = getattr(first_ds, 'SeriesNumber', 0)
+        
+        # Create a unique key for this acquisition: (date, time)
+        acquisition_key = (acquisition_date, acquisition_time)
+        acquisition_groups[acquisition_key].append({
+            'series_uid': series_uid,
+            'files': sorted_files,
+            'protocol_name': protocol_name,
+            'series_number': series_number
+        })
+    
+    # Sort acquisitions by date/time, and series within each acquisition by series number
+    sorted_acquisitions = []
+    for (acq_date, acq_time), series_list in sorted(acquisition_groups.items()):
+        # Sort series within this acquisition by series number
+        sorted_series_list = sorted(series_list, key=lambda x: x['series_number'])
+        # Get protocol name from the first series (they should all be the same)
+        protocol_name = sorted_series_list[0]['protocol_name']
+        # Convert to (series_uid, files) tuples
+        series_tuples = [(s['series_uid'], s['files']) for s in sorted_series_list]
+        sorted_acquisitions.append((protocol_name, series_tuples))
+    return sorted_acquisitions
+
+def reference_series_info(ref_nifti):
+    """
+    Read ProtocolName and SequenceName of a converted reference scan from the
+    BIDS sidecar (e.g. ref1.json next to ref1.nii) written by dcm2niix.
+    Returns (protocol_name, sequence_name), entries are None if not available.
+    """
+    base = ref_nifti[:-len('.nii.gz')] if ref_nifti.endswith('.nii.gz') else os.path.splitext(ref_nifti)[0]
+    try:
+        with open(base + '.json') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    return sidecar.get('ProtocolName'), sidecar.get('SequenceName')
+
+def series_matches(header, protocol_name, sequence_name=None):
+    """
+    Check whether a series header matches the given protocol (and sequence) name.
+    """
+    if getattr(header, 'ProtocolName', None) != protocol_name:
+        return False
+    return sequence_name is None or getattr(header, 'SequenceName', None) == sequence_name
+
+def find_series(series_dict, series_number):
+    """
+    Files of the series with the given series number or series CRC (as used by
+    dcm2niix -n) in series_dict (DicomHeaderIndex.series_dict), None if not found.
+    """
+    for series_uid, files in series_dict.items():
+        first_ds = files[0][1]
+        if str(series_number) in (str(getattr(first_ds, 'SeriesNumber', None)),
+                                  str(calculate_series_crc(first_ds))):
+            return files
+    return None
+
+def predict_series(sorted_acquisitions, protocol_name=None, sequence_name=None, quiet_period=3.0):
+    """
+    Guess the series the operator is going to select in the menu: the newest series
+    matching the reference protocol (and sequence) name, or the newest series if none
+    matches. Series with files modified within the last quiet_period seconds are still
+    being exported and not considered. Returns (series_uid, files) or None.
+    """
+    now = time.time()
+
+    def complete(files):
+        try:
+            return max(os.path.getmtime(path) for path, _ in files) < now - quiet_period
+        except OSError:
+            return False
+
+    # group_acquisitions sorts by acquisition time and series number, the newest is last
+    candidates = [(series_uid, files) for _, series_list in sorted_acquisitions
+                  for series_uid, files in series_list if complete(files)]
+    if protocol_name is not None:
+        matching = [(series_uid, files) for series_uid, files in candidates
+                    if series_matches(files[0][1], protocol_name, sequence_name)]
+        candidates = matching or candidates
+    return candidates[-1] if candidates else None
+
+class ExportFollower:
+    """
+    Blocks until files in a directory tree change, using inotify (inotify_simple)
+    when available and plain sleeping (polling) otherwise.
+    """
+    def __init__(self, dicom_dir, poll_interval=1.0):
+        self.dicom_dir = dicom_dir
+        self.poll_interval = poll_interval
+        self.watched = set()
+        # inotify watch descriptor -> directory
+        self.directories = {}
+        try:
+            from inotify_simple import INotify, flags
+            self.flags = flags
+            self.inotify = INotify()
+            self._add_watches()
+        except (ImportError, OSError):
+            self.inotify = None
+
+    def _add_watches(self):
+        mask = (self.flags.CREATE | self.flags.CLOSE_WRITE | self.flags.MOVED_TO |
+                self.flags.DELETE)
+        for root, _, _ in os.walk(self.dicom_dir):
+            if root not in self.watched:
+                self.directories[self.inotify.add_watch(root, mask)] = root
+                self.watched.add(root)
+
+    def wait(self, timeout):
+        """
+        Wait at most timeout seconds, returns earlier if files changed (inotify only).
+        Returns the paths of the files written or moved in meanwhile (inotify) or None (polling).
+        """
+        if self.inotify is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return None
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        if any(event.mask & self.flags.ISDIR for event in events):
+            self._add_watches()
+        written = self.flags.CLOSE_WRITE | self.flags.MOVED_TO
+        return [os.path.join(self.directories[event.wd], event.name) for event in events
+                if event.mask & written and not event.mask & self.flags.ISDIR and event.wd in self.directories]
+
+def holds_volume(file_path):
+    """
+    Whether a DICOM file holds a whole volume (mosaic or multi-frame) rather than a single slice.
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    try:
+        ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=['ImageType', 'NumberOfFrames'])
+    except (InvalidDicomError, OSError):
+        return False
+    return 'MOSAIC' in getattr(ds, 'ImageType', []) or int(getattr(ds, 'NumberOfFrames', 1) or 1) > 1
+
+class SeriesWatcher:
+    """
+    Follows a (realtime) DICOM export directory and reports series matching a
+    protocol/sequence name once they are complete.
+
+    A series is considered complete when it has at least expected_count files
+    (if given, only for series with one slice per file) and no new files arrived for
+    quiet_period seconds. Series that are already complete when the watcher is started
+    are ignored unless include_existing is set, series that are still arriving are followed.
+    The header index is stored when a series completes or waiting ends, not on every poll.
+    """
+    def __init__(self, dicom_dir, protocol_name, sequence_name=None, expected_count=None,
+                 quiet_period=3.0, poll_interval=1.0, include_existing=False):
+        self.protocol_name = protocol_name
+        self.sequence_name = sequence_name
+        self.expected_count = expected_count
+        self.quiet_period = quiet_period
+        self.index = DicomHeaderIndex(dicom_dir)
+        self.follower = ExportFollower(self.index.dicom_dir, poll_interval)
+        # series uid -> (number of files, time of last change)
+        self.progress = {}
+        self.reported = set()
+        # series uid -> whether its files hold whole volumes
+        self.whole_volumes = {}
+        if not include_existing:
+            self.index.refresh()
+            now_ns = time.time_ns()
+            for series_uid, files in self.index.series_dict().items():
+                if (series_matches(files[0][1], self.protocol_name, self.sequence_name) and
+                        self._looks_complete(series_uid, files, now_ns)):
+                    self.reported.add(series_uid)
+
+    def _expected_count(self, series_uid, files):
+        # expected_count counts slices, mosaic/multi-frame series only wait for the quiet period
+        if not self.expected_count:
+            return None
+        if series_uid not in self.whole_volumes:
+            self.whole_volumes[series_uid] = holds_volume(files[0][0])
+        return None if self.whole_volumes[series_uid] else self.expected_count
+
+    def _looks_complete(self, series_uid, files, now_ns):
+        # expected number of files reached or no file written within the quiet period
+        expected_count = self._expected_count(series_uid, files)
+        if expected_count and len(files) >= expected_count:
+            return True
+        newest = max(self.index.entries[file_path][1] for file_path, _ in files)
+        return now_ns - newest >= self.quiet_period * 1e9
+
+    def poll(self):
+        """
+        Rescan the export, returns a list of newly completed matching (series_uid, files).
+        """
+        self.index.refresh(save=False)
+        now = time.monotonic()
+        completed = []
+        for series_uid, files in self.index.series_dict().items():
+            if series_uid in self.reported or not series_matches(files[0][1], self.protocol_name,
+                                                                  self.sequence_name):
+                continue
+            n_files, last_change = self.progress.get(series_uid, (None, now))
+            if n_files != len(files):
+                self.progress[series_uid] = (len(files), now)
+                continue
+            expected_count = self._expected_count(series_uid, files)
+            if expected_count and n_files < expected_count:
+                continue
+            if now - last_change >= self.quiet_period:
+                self.reported.add(series_uid)
+                completed.append((series_uid, files))
+        if completed:
+            self.save_index()
+        return completed
+
+    def save_index(self):
+        try:
+            self.index.save()
+        except OSError as e:
+            print(f"Warning: could not save DICOM header index: {e}")
+
+    def wait(self, timeout=None):
+        """
+        Block until a matching series is complete and return it as (series_uid, files),
+        or None after timeout seconds.
+        """
+        start = time.monotonic()
+        try:
+            while True:
+                completed = self.poll()
+                if completed:
+                    return completed[0]
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    self.save_index()
+                    return None
+                self.follower.wait(min(self.quiet_period, self.follower.poll_interval))
+        except BaseException:
+            self.save_index()
+            raise
+
+def interactive_menu(stdscr, sorted_acquisitions, speculator=None):
     """
     Interactive menu using arrow keys to select a series.
     Returns the selected series number.
+    With a speculator (see dicom_series_selector), the progress of its background work
+    is shown next to the series it works on.
     """
     curses.curs_set(0)  # Hide cursor
     stdscr.clear()
+    if speculator is not None:
+        # redraw regularly to update the progress
+        stdscr.timeout(500)
     
     # Build a flat list of series with their info
     menu_items = []
@@ -51,7 +496,7 @@ def interactive_menu(stdscr, sorted_acquisitions):
             
             display_text = f"  Series {series_number}: {series_description} [{len(files)}]"
             menu_items.append(('series', display_text, series_number, (series_uid, files)))
-    
+
     current_row = 0
     # Find first selectable item
     while current_row < len(menu_items) and menu_items[current_row][0] == 'header':
@@ -80,6 +525,10 @@ def interactive_menu(stdscr, sorted_acquisitions):
                 break
                 
             item_type, text, series_num, data = menu_items[idx]
+            if item_type == 'series' and speculator is not None:
+                status = speculator.status(data[0])
+                if status:
+                    text += f"  <- {status}"
             
             if item_type == 'header':
                 stdscr.addstr(y, 0, text[:w-1], curses.A_BOLD)
@@ -117,71 +566,33 @@ def interactive_menu(stdscr, sorted_acquisitions):
         elif key == ord('q') or key == ord('Q'):
             return None, None
 
-def dicom_series_selector(dicom_dir, menu_type='simple'):
+def dicom_series_selector(dicom_dir, menu_type='simple', return_files=False, speculator=None):
     """
     Select a DICOM series from a given DICOM export directory.
 
     Parameters:
     dicom_dir (str): Path to the directory containing DICOM files.
     menu_type (str): Type of menu to display for selection. Default is 'simple'.
+    return_files (bool): Also return the files of the selected series. Default is False.
+    speculator: Optional object working on the most likely series in the background
+        while the menu is open (e.g. asrs_speculate.SpeculativeRegistration). It is
+        passed the acquisitions after every scan (update(sorted_acquisitions)) and asked
+        for a progress text per series (status(series_uid)).
 
     Returns:
-    for now, only prints a number of information about the selected series.
+    the series CRC of the selected series (as used by dcm2niix -n), or
+    (series CRC, list of (file_path, header) tuples) if return_files is True,
+    after printing a number of information about the selected series.
     (e.g. series number, series CRC, number of files, name of first file, etc.)
     """
-    import os
-    import pydicom
-    from pydicom.errors import InvalidDicomError
-    from collections import defaultdict
+    index = DicomHeaderIndex(dicom_dir)
 
     while True:  # Main loop to allow refreshing
-        # Gather all DICOM files in the directory
-        dicom_files = []
-        for root, _, files in os.walk(dicom_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    ds = pydicom.dcmread(file_path, stop_before_pixels=True)
-                    dicom_files.append((file_path, ds))
-                except InvalidDicomError:
-                    continue
-
-        # Group files by Series Instance UID
-        series_dict = defaultdict(list)
-        for file_path, ds in dicom_files:
-            series_uid = ds.SeriesInstanceUID
-            series_dict[series_uid].append((file_path, ds))
-
-        # Group series by AcquisitionDate and AcquisitionTime
-        acquisition_groups = defaultdict(list)
-        for series_uid, files in series_dict.items():
-            # Sort files alphabetically to get consistent first file
-            sorted_files = sorted(files, key=lambda x: x[0])
-            first_ds = sorted_files[0][1]
-            acquisition_date = getattr(first_ds, 'AcquisitionDate', '')
-            acquisition_time = getattr(first_ds, 'AcquisitionTime', '')
-            protocol_name = getattr(first_ds, 'ProtocolName', None)
-            series_number = getattr(first_ds, 'SeriesNumber', 0)
-            
-            # Create a unique key for this acquisition: (date, time)
-            acquisition_key = (acquisition_date, acquisition_time)
-            acquisition_groups[acquisition_key].append({
-                'series_uid': series_uid,
-                'files': sorted_files,
-                'protocol_name': protocol_name,
-                'series_number': series_number
-            })
-        
-        # Sort acquisitions by date/time, and series within each acquisition by series number
-        sorted_acquisitions = []
-        for (acq_date, acq_time), series_list in sorted(acquisition_groups.items()):
-            # Sort series within this acquisition by series number
-            sorted_series_list = sorted(series_list, key=lambda x: x['series_number'])
-            # Get protocol name from the first series (they should all be the same)
-            protocol_name = sorted_series_list[0]['protocol_name']
-            # Convert to (series_uid, files) tuples
-            series_tuples = [(s['series_uid'], s['files']) for s in sorted_series_list]
-            sorted_acquisitions.append((protocol_name, series_tuples))
+        # Only files that are new or changed since the last scan are parsed
+        index.refresh()
+        sorted_acquisitions = group_acquisitions(index.series_dict())
+        if speculator is not None:
+            speculator.update(sorted_acquisitions)
         
         # Build a dictionary mapping series number to (series_uid, files)
         series_number_map = {}
@@ -196,12 +607,13 @@ def dicom_series_selector(dicom_dir, menu_type='simple'):
         if menu_type == 'interactive':
             # Use curses for interactive selection
             try:
-                selected_series_num, selected_data = curses.wrapper(interactive_menu, sorted_acquisitions)
+                selected_series_num, selected_data = curses.wrapper(interactive_menu, sorted_acquisitions,
+                                                                            speculator)
                 if selected_series_num == 'refresh':
                     continue  # Restart the loop to rescan
                 if selected_series_num is None:
                     print("Selection cancelled")
-                    return
+                    return (None, None) if return_files else None
                 selected_series_uid, selected_files = selected_data
                 break  # Exit the loop after successful selection
             except Exception as e:
@@ -245,17 +657,17 @@ def dicom_series_selector(dicom_dir, menu_type='simple'):
                 continue  # Restart the loop to rescan
             elif selection.lower() == 'q':
                 print("Selection cancelled")
-                return
+                return (None, None) if return_files else None
             
             try:
                 selection = int(selection)
             except ValueError:
                 print(f"Error: Invalid input")
-                return
+                return (None, None) if return_files else None
             
             if selection not in series_number_map:
                 print(f"Error: Series number {selection} not found")
-                return
+                return (None, None) if return_files else None
             
             selected_series_uid, selected_files = series_number_map[selection]
             break  # Exit the loop after successful selection
@@ -270,6 +682,8 @@ def dicom_series_selector(dicom_dir, menu_type='simple'):
     print(f"Series CRC: {series_crc}")
     print(f"Number of Files: {len(selected_files)}")
     print(f"First File Path: {first_file_path}")
+    if return_files:
+        return series_crc, sorted_files
     return series_crc
 
 